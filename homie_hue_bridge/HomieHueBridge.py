@@ -1,12 +1,19 @@
 import os
 import shutil
 import time
+import asyncio
 import logging
 import argparse
+from collections import defaultdict, deque
 
 import homie
 
 from homie_hue_bridge.HueSSDP import SSDP
+from homie_hue_bridge.HueAsyncRuntime import HueAsyncRuntime
+from homie_hue_bridge.HomieTopicRouter import HomieTopicRouter
+from homie_hue_bridge.HomieRateLimiter import HomieRateLimiter
+from homie_hue_bridge import HueColor
+from homie_hue_bridge.HomieValueMap import compile_property
 from homie_hue_bridge.HueBridgeEmulator import (
     HueBridgeEmulator,
     get_mac,
@@ -27,31 +34,65 @@ logging.basicConfig(level=logging.DEBUG)
 
 
 class BridgeDevice:
-    def __init__(self, did, config, properties, homie, update_hue_device):
+    max_echoes = 16
+    # Seconds a device has to echo a value back
+    echo_timeout = 2
+
+    def __init__(
+        self, did, config, properties, homie, update_hue_device, timers, gamut=None
+    ):
         self._did = did
         self._config = config
         self._properties = properties
         self._homie = homie
         self._update_hue_device = update_hue_device
-        self.subscribe()
+        self._gamut = gamut
 
-    def subscribe(self):
-        for p in self._properties:
-            prop = self._config.get(f"property_{p}", p)
-            addr = f"{self._homie.baseTopic}/{self._config['address']}/{prop}"
-            logger.info("Subscribing to %s", addr)
-            self._mqtt_subscribe(addr, self.mqttHandler)
+        self._color_format = config.get("color_format", "ct")
+        if self._color_format not in HueColor.FORMATS:
+            raise ValueError(
+                f"Unknown color_format {self._color_format} for device {did}"
+            )
+        self._maps = {
+            p: compile_property(p, config, self._color_format, gamut)
+            for p in properties
+        }
 
-    def _mqtt_subscribe(self, topic, callback):
-        self._homie._checkBeforeSetup()
+        self._limiter = None
+        property_rates = {
+            p: config[f"publish_rate_{p}"]
+            for p in properties
+            if f"publish_rate_{p}" in config
+        }
+        if "publish_rate" in config or property_rates:
+            self._limiter = HomieRateLimiter(
+                timers,
+                self._send,
+                config.get("publish_rate"),
+                config.get("publish_burst", 1),
+                property_rates,
+            )
 
-        if not self._homie.subscribe_all:
-            self._homie.subscriptions.append((topic, int(self._homie.qos)))
+        # Last value known to both sides, and (time, value) sent to the device
+        # that it has not echoed back yet, keyed by hue property. Outgoing
+        # values are stored as they decode from their payload so they compare
+        # equal to what the device reports
+        self._values = {}
+        self._sent = defaultdict(lambda: deque(maxlen=self.max_echoes))
 
-        if self._homie.mqtt_connected:
-            self._homie._subscribe()
+        self.published = 0
+        self.unchanged = 0
+        self.echoes = 0
+        self.repeated = 0
 
-        self._homie.mqtt.message_callback_add(topic, callback)
+    def routes(self):
+        for p in self._properties:
+            prop = self._config.get(f"property_{p}", p)
+            yield (
+                f"{self._homie.baseTopic}/{self._config['address']}/{prop}",
+                self._maps[p].hue_property,
+                self._maps[p].decode,
+            )
 
     def set(self, property, payload, retain=True):
         addr = f"{self._homie.baseTopic}/{self._config['address']}/{property}/set"
@@ -60,88 +101,161 @@ class BridgeDevice:
             addr, payload=str(payload), retain=retain,
         )
 
-    def mqttHandler(self, mqttc, obj, msg):
-        parts = msg.topic.split("/")
-        if parts[0] != self._homie.baseTopic:
-            return
+    def stats(self):
+        stats = {
+            "published": self.published,
+            "unchanged": self.unchanged,
+            "echoes": self.echoes,
+            "repeated": self.repeated,
+        }
+        if self._limiter:
+            stats["limiter"] = self._limiter.stats()
 
-        prop = parts[-1]
-        mapped_prop = None
-        for k, v in self._config.items():
-            if k.startswith("property_"):
-                if v == prop:
-                    mapped_prop = k.replace("property_", "")
+        return stats
 
-        if mapped_prop:
-            logger.info("Mapping property %s to %s", prop, mapped_prop)
-            prop = mapped_prop
+    def _publish(self, prop, value, retain=True):
+        if value is None:
+            return
 
-        value = msg.payload.decode("utf-8")
+        payload = self._maps[prop].encode(value)
+        value = self._maps[prop].decode(payload)
+        hue_prop = self._maps[prop].hue_property
+        if self._values.get(hue_prop) == value:
+            self.unchanged += 1
+            return
 
-        if prop == "on":
-            mapped_value = {
-                str(self._config.get(f"value_on", "1")): True,
-                str(self._config.get(f"value_off", "0")): False,
-            }
+        self._values[hue_prop] = value
+        if self._limiter:
+            self._limiter.submit(prop, (payload, value, retain))
+        else:
+            self._send(prop, (payload, value, retain))
+
+    def _send(self, prop, update):
+        payload, value, retain = update
+        self._sent[self._maps[prop].hue_property].append((time.monotonic(), value))
+        self.published += 1
+        self.set(self._config.get(f"property_{prop}", prop), payload, retain=retain)
+
+    def update_from_homie(self, prop, value):
+        sent = self._sent[prop]
+        expired = time.monotonic() - self.echo_timeout
+        while sent and sent[0][0] < expired:
+            sent.popleft()
+
+        if any(v == value for _, v in sent):
+            # The device reporting a value we set, drop it and anything older
+            while sent.popleft()[1] != value:
+                pass
+            self.echoes += 1
+            return
 
-            if value in mapped_value:
-                logger.info("Mapping value %s, to %s", value, mapped_value[value])
-                value = mapped_value[value]
+        # Anything else means pending values will not be echoed any more
+        sent.clear()
 
-            else:
-                value = value == "1"
+        if self._values.get(prop) == value:
+            self.repeated += 1
+            return
 
-        logger.info("Updating hue from homie %s, %s", msg.topic, value)
+        logger.info("Updating hue from homie %s %s, %s", self._did, prop, value)
+        self._values[prop] = value
         self._update_hue_device(self._did, prop, value)
 
-    def update_from_hue(self, on, cri, bri):
+    def update_from_hue(self, state):
         values = {
-            "on": {
-                True: self._config.get(f"value_on", 1),
-                False: self._config.get(f"value_off", 0),
-            },
-            "color": cri,
-            "brightness": bri,
+            "on": state.get("on"),
+            "brightness": state.get("bri"),
+            "color": HueColor.from_state(state, self._color_format, self._gamut),
         }
+        for prop in self._properties:
+            self._publish(prop, values[prop])
 
+    def update_from_stream(self, on, rgb, bri):
+        values = {
+            "on": on,
+            "brightness": bri,
+            "color": HueColor.from_rgb(rgb, self._color_format, self._gamut),
+        }
         for prop in self._properties:
-            p = self._config.get(f"property_{prop}", prop)
-            if prop == "on":
-                self.set(p, values["on"][on])
-            else:
-                self.set(p, values[prop])
+            self._publish(prop, values[prop], retain=False)
 
 
 class Huebridge:
     _devices = {}
+    # Topics per SUBSCRIBE packet, brokers may cap packet size
+    subscribe_batch = 64
 
     def __init__(self, homie, args, config):
         self._args = args
         self._homie = homie
         self._config = config
+        self._router = HomieTopicRouter(homie.baseTopic)
 
         self.setup()
 
-    def _device_changed(self, lid, on, cri, bri):
+    def _device_changed(self, lid, state):
         if lid in self._devices:
-            self._devices[lid].update_from_hue(on, cri, bri)
+            self._devices[lid].update_from_hue(state)
 
         else:
             logger.warning("Recieved update for unregistered device %s", lid)
 
+    def _device_streamed(self, lid, on, rgb, bri):
+        if lid in self._devices:
+            self._devices[lid].update_from_stream(on, rgb, bri)
+
+    def stats(self):
+        return {did: device.stats() for did, device in self._devices.items()}
+
+    def subscribe(self):
+        # Homie only sets up its mqtt client in Homie.setup()
+        on_connect = self._homie.mqtt.on_connect
+
+        def _connected(*args):
+            on_connect(*args)
+            self._subscribe()
+
+        self._homie.mqtt.on_connect = _connected
+        self._homie.mqtt.message_callback_add(
+            self._router.callback_filter, self._router.on_message
+        )
+        if self._homie.mqtt_connected:
+            self._subscribe()
+
+    def _subscribe(self):
+        if self._args.subscribe == "exact":
+            topics = self._router.topics()
+        else:
+            topics = self._router.subscriptions()
+
+        qos = int(self._homie.qos)
+        logger.info("Subscribing to %d topic(s)", len(topics))
+        for i in range(0, len(topics), self.subscribe_batch):
+            self._homie.mqtt.subscribe(
+                [(topic, qos) for topic in topics[i : i + self.subscribe_batch]]
+            )
+
     def _sync_devices(self):
         hue_devices = self.hb.get_devices()
+        self._router.clear()
         for did, device_config in self._config["HUEDEVICES"].items():
             if did not in hue_devices:
                 self.hb.add_device(did, device_config["type"], device_config["name"])
 
+            control = hue_devices[did].get("capabilities", {}).get("control", {})
             self._devices[did] = BridgeDevice(
                 did,
                 device_config,
                 self.hb.get_properties(device_config["type"]),
                 self._homie,
                 self.hb.set_light_state,
+                self.hb.timers,
+                control.get("colorgamut"),
             )
+            for topic, prop, decode in self._devices[did].routes():
+                self._router.add(topic, self._devices[did], prop, decode)
+
+            if self.hb.entertainment and "stream_rate" in device_config:
+                self.hb.entertainment.set_rate(did, device_config["stream_rate"])
 
         to_rem = []
         for hid in hue_devices.keys():
@@ -151,8 +265,6 @@ class Huebridge:
         for hid in to_rem:
             self.hb.remove_device(hid)
 
-        self.hb.save_config()
-
     def setup(self):
         if self._args.mac:
             mac = self._args.mac
@@ -165,7 +277,6 @@ class Huebridge:
             ip = get_ip_address(self._args.port)
 
         self.ssdp = SSDP(ip, self._args.port, mac)
-        self.ssdp.start()
 
         config_dir = self._args.config_dir or "config"
         if not os.path.exists(f"{config_dir}/hue.json"):
@@ -173,9 +284,28 @@ class Huebridge:
                 f"{os.path.dirname(__file__)}/data/base.json", f"{config_dir}/hue.json"
             )
 
-        self.hb = HueBridgeEmulator(ip, self._args.port, mac, f"{config_dir}/hue.json")
+        self.hb = HueBridgeEmulator(
+            ip,
+            self._args.port,
+            mac,
+            f"{config_dir}/hue.json",
+            workers=int(self._args.workers),
+            device_types=f"{config_dir}/device_types.json",
+            journal=self._args.journal,
+        )
         self.hb.add_light_callbacks(self._device_changed)
+        self.hb.add_metrics_provider("homie", self.stats)
+        if self._args.entertainment:
+            self.hb.enable_entertainment(
+                int(self._args.entertainment_port),
+                self._args.entertainment == "dtls",
+                float(self._args.stream_rate),
+            )
+            self.hb.add_stream_callbacks(self._device_streamed)
         self._sync_devices()
+
+    def start(self):
+        self.ssdp.start()
         self.hb.start()
 
     def shutdown(self):
@@ -197,6 +327,49 @@ def parse_args():
     parser.add_argument(
         "--config-dir", dest="config_dir", help="Config dir to use",
     )
+    parser.add_argument(
+        "--asyncio",
+        action="store_true",
+        dest="asyncio",
+        help="Run http, ssdp, the scheduler and mqtt on a single event loop",
+    )
+    parser.add_argument(
+        "--workers",
+        default=4,
+        dest="workers",
+        help="Number of workers forwarding hue updates to homie",
+    )
+    parser.add_argument(
+        "--entertainment",
+        choices=["dtls", "plaintext"],
+        dest="entertainment",
+        help="Accept hue entertainment streams (plaintext is for local testing)",
+    )
+    parser.add_argument(
+        "--entertainment-port",
+        default=2100,
+        dest="entertainment_port",
+        help="Port to receive entertainment streams on",
+    )
+    parser.add_argument(
+        "--stream-rate",
+        default=25,
+        dest="stream_rate",
+        help="Max frames per second published to a homie device while streaming",
+    )
+    parser.add_argument(
+        "--subscribe",
+        choices=["wildcard", "exact"],
+        default="wildcard",
+        dest="subscribe",
+        help="Subscribe to all homie properties or only those of configured devices",
+    )
+    parser.add_argument(
+        "--journal",
+        action="store_true",
+        dest="journal",
+        help="Append config changes to a journal rather than rewriting the config",
+    )
 
     return parser.parse_args()
 
@@ -210,10 +383,17 @@ def main():
 
     Homie.setFirmware("huebridge", "1.0.0")
     Homie.setup()
+    hue.subscribe()
 
     try:
-        while True:
-            time.sleep(1)
+        if args.asyncio:
+            runtime = HueAsyncRuntime(hue.hb, hue.ssdp, Homie.mqtt)
+            asyncio.run(runtime.run())
+
+        else:
+            hue.start()
+            while True:
+                time.sleep(1)
 
     finally:
         hue.shutdown()
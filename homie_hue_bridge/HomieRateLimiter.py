@@ -0,0 +1,92 @@
+import time
+from threading import Lock
+
+
+class TokenBucket:
+    def __init__(self, rate, burst=1):
+        self.rate = float(rate)
+        self.burst = float(burst)
+        self._tokens = self.burst
+        self._updated = time.monotonic()
+
+    def wait(self, now):
+        # Seconds until a token is available
+        self._tokens = min(self.burst, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+        return max(0, (1 - self._tokens) / self.rate)
+
+    def take(self):
+        self._tokens -= 1
+
+
+class HomieRateLimiter:
+    # Token buckets for a device and optionally each of its properties.
+    # Publishes over the limit are held back, collapsing to the latest
+    # value per property, and sent from the timer queue once tokens refill
+    def __init__(self, timers, send, rate=None, burst=1, property_rates=None):
+        self._timers = timers
+        self._send = send
+        self._device = TokenBucket(rate, burst) if rate else None
+        self._properties = {
+            prop: TokenBucket(prop_rate, burst)
+            for prop, prop_rate in (property_rates or {}).items()
+        }
+
+        self._pending = {}
+        self._lock = Lock()
+
+        self.sent = 0
+        self.delayed = 0
+        self.coalesced = 0
+
+    def stats(self):
+        return {
+            "sent": self.sent,
+            "delayed": self.delayed,
+            "coalesced": self.coalesced,
+            "pending": len(self._pending),
+        }
+
+    def _buckets(self, prop):
+        return [b for b in (self._device, self._properties.get(prop)) if b]
+
+    def _acquire(self, prop):
+        # Takes a token from every bucket for prop, or returns the wait
+        now = time.monotonic()
+        buckets = self._buckets(prop)
+        wait = max([b.wait(now) for b in buckets], default=0)
+        if wait == 0:
+            for b in buckets:
+                b.take()
+
+        return wait
+
+    def submit(self, prop, value):
+        with self._lock:
+            if prop in self._pending:
+                self.coalesced += 1
+                self._pending[prop] = value
+                return
+
+            wait = self._acquire(prop)
+            if wait:
+                self.delayed += 1
+                self._pending[prop] = value
+                self._timers.call_later(wait, self._flush, prop)
+                return
+
+            self.sent += 1
+
+        self._send(prop, value)
+
+    def _flush(self, prop):
+        with self._lock:
+            wait = self._acquire(prop)
+            if wait:
+                self._timers.call_later(wait, self._flush, prop)
+                return
+
+            value = self._pending.pop(prop)
+            self.sent += 1
+
+        self._send(prop, value)
@@ -0,0 +1,52 @@
+import logging
+
+logger = logging.getLogger(__name__)
+
+
+class HomieTopicRouter:
+    # Routes every homie property message from one wildcard subscription
+    # with a single dict lookup on the full topic. Devices whose address is
+    # not two levels deep are subscribed to separately
+    def __init__(self, base_topic):
+        self._base_topic = base_topic
+        self._routes = {}
+
+    @property
+    def subscription(self):
+        return f"{self._base_topic}/+/+/+"
+
+    @property
+    def callback_filter(self):
+        # Any depth, whichever topics were subscribed to
+        return f"{self._base_topic}/#"
+
+    def topics(self):
+        return list(self._routes.keys())
+
+    def subscriptions(self):
+        # The wildcard and the routed topics it does not match
+        depth = self.subscription.count("/")
+        return [self.subscription] + [
+            topic for topic in self._routes if topic.count("/") != depth
+        ]
+
+    def add(self, topic, device, hue_property, decode):
+        logger.debug("Routing %s to %s", topic, hue_property)
+        self._routes[topic] = (device, hue_property, decode)
+
+    def clear(self):
+        self._routes = {}
+
+    def on_message(self, mqttc, obj, msg):
+        route = self._routes.get(msg.topic)
+        if route is None:
+            return
+
+        device, hue_property, decode = route
+        try:
+            value = decode(msg.payload.decode("utf-8"))
+        except ValueError:
+            logger.warning("Could not decode %s from %s", msg.payload, msg.topic)
+            return
+
+        device.update_from_homie(hue_property, value)
@@ -0,0 +1,109 @@
+import json
+
+from homie_hue_bridge import HueColor
+
+# Homie property => hue light state
+HUE_PROPERTIES = {"on": "on", "brightness": "bri", "color": "ct"}
+
+# Value ranges on the hue side, and the homie ones assumed unless a device
+# sets range_<property>
+HUE_RANGES = {"bri": (1, 254), "ct": (HueColor.CT_MIN, HueColor.CT_MAX)}
+HOMIE_RANGES = {"brightness": (0, 100)}
+
+TRUE_VALUES = ["true", "1", "on", "yes"]
+FALSE_VALUES = ["false", "0", "off", "no"]
+
+
+class ValueMap:
+    # encode turns a hue value into a homie payload, decode a payload into a
+    # hue value (raising ValueError for payloads it cannot parse)
+    __slots__ = ["hue_property", "encode", "decode"]
+
+    def __init__(self, hue_property, encode, decode):
+        self.hue_property = hue_property
+        self.encode = encode
+        self.decode = decode
+
+
+def _boolean(config):
+    value_on = str(config.get("value_on", 1))
+    value_off = str(config.get("value_off", 0))
+    values = {v: True for v in TRUE_VALUES}
+    values.update({v: False for v in FALSE_VALUES})
+    values[value_on.lower()] = True
+    values[value_off.lower()] = False
+
+    def decode(payload):
+        try:
+            return values[payload.strip().lower()]
+        except KeyError:
+            raise ValueError(f"Not a boolean {payload}")
+
+    return lambda value: value_on if value else value_off, decode
+
+
+def _numeric(hue_range, homie_range):
+    low, high = hue_range
+
+    def clamp(value):
+        return min(max(int(round(value)), low), high)
+
+    if not homie_range or list(homie_range) == [low, high]:
+        return lambda value: str(int(value)), lambda payload: clamp(float(payload))
+
+    homie_low, homie_high = homie_range
+    scale = (high - low) / (homie_high - homie_low)
+    integer = all(isinstance(v, int) for v in homie_range)
+
+    def encode(value):
+        scaled = homie_low + (value - low) / scale
+        return str(int(round(scaled))) if integer else str(round(scaled, 2))
+
+    return encode, lambda payload: clamp(low + (float(payload) - homie_low) * scale)
+
+
+def _color(color_format, gamut):
+    def encode(value):
+        if isinstance(value, tuple):
+            return ",".join(str(c) for c in value)
+
+        return str(value)
+
+    return encode, lambda payload: HueColor.to_state(payload, color_format, gamut)[1]
+
+
+def _enum(values, encode, decode):
+    # values maps hue values (as json, e.g. "true" or "254") to homie
+    # payloads, anything else falls through to encode/decode
+    encoded = {json.dumps(json.loads(k)): str(v) for k, v in values.items()}
+    decoded = {v: json.loads(k) for k, v in encoded.items()}
+
+    def encode_enum(value):
+        key = json.dumps(value)
+        return encoded[key] if key in encoded else encode(value)
+
+    def decode_enum(payload):
+        return decoded[payload] if payload in decoded else decode(payload)
+
+    return encode_enum, decode_enum
+
+
+def compile_property(prop, config, color_format="ct", gamut=None):
+    hue_property = HUE_PROPERTIES[prop]
+    if prop == "on":
+        encode, decode = _boolean(config)
+
+    elif prop == "color" and color_format != "ct":
+        hue_property = "xy"
+        encode, decode = _color(color_format, gamut)
+
+    else:
+        encode, decode = _numeric(
+            HUE_RANGES[hue_property],
+            config.get(f"range_{prop}", HOMIE_RANGES.get(prop)),
+        )
+
+    if f"values_{prop}" in config:
+        encode, decode = _enum(config[f"values_{prop}"], encode, decode)
+
+    return ValueMap(hue_property, encode, decode)
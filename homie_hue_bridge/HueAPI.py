@@ -0,0 +1,449 @@
+import logging
+from datetime import datetime, timedelta
+
+logger = logging.getLogger(__name__)
+
+
+class HueAPI:
+    # Creates, updates and deletes bridge resources for the http server and
+    # for rule and schedule actions, which call it directly rather than over
+    # http. Paths are split as ["", "api", <user>, <resource>, ...] and bodies
+    # are already parsed. Changes are made holding the state store lock
+    def __init__(self, parent):
+        self._parent = parent
+
+    def authorized(self, user):
+        return user in self._parent.bridge_config["config"]["whitelist"]
+
+    def request(self, method, address, body):
+        url_pices = address.split("/")
+        if len(url_pices) < 4 or not self.authorized(url_pices[2]):
+            logger.warning("Unauthorized action %s %s", method, address)
+            return [
+                {
+                    "error": {
+                        "type": 1,
+                        "address": address,
+                        "description": "unauthorized user",
+                    }
+                }
+            ]
+
+        if method == "PUT":
+            return self.update(url_pices, body)
+        if method == "POST":
+            return self.create(url_pices, body)
+        if method == "DELETE":
+            return self.delete(url_pices)
+
+        logger.warning("Unsupported action method %s %s", method, address)
+
+    def create(self, url_pices, post_dictionary):
+        if self.scan(url_pices, post_dictionary):
+            self._parent.run_task(self._parent.scan_for_lights)
+            return [{"success": {"/" + url_pices[3]: "Searching for new devices"}}]
+
+        with self._parent.state.lock:
+            return self._create(url_pices, post_dictionary)
+
+    def update(self, url_pices, put_dictionary):
+        with self._parent.state.lock:
+            return self._update(url_pices, put_dictionary)
+
+    def delete(self, url_pices):
+        with self._parent.state.lock:
+            return self._delete(url_pices)
+
+    def scan(self, url_pices, post_dictionary):
+        # An empty POST to lights or sensors searches for new devices
+        return url_pices[3] in ["lights", "sensors"] and not bool(post_dictionary)
+
+    def _create(self, url_pices, post_dictionary):
+        # find the first unused id for new object
+        i = 1
+        while (str(i)) in self._parent.bridge_config[url_pices[3]]:
+            i += 1
+        if url_pices[3] == "scenes":
+            post_dictionary.update(
+                {
+                    "lightstates": {},
+                    "version": 2,
+                    "picture": "",
+                    "lastupdated": datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S"),
+                }
+            )
+        elif url_pices[3] == "groups":
+            post_dictionary.update(
+                {
+                    "action": {"on": False},
+                    "state": {"any_on": False, "all_on": False},
+                }
+            )
+        elif url_pices[3] == "schedules":
+            post_dictionary.update(
+                {"created": datetime.now().strftime("%Y-%m-%dT%H:%M:%S")}
+            )
+            if post_dictionary["localtime"].startswith("PT"):
+                timmer = post_dictionary["localtime"][2:]
+                h, m, s = timmer.split(":")
+                d = timedelta(hours=int(h), minutes=int(m), seconds=int(s))
+                post_dictionary.update(
+                    {"starttime": (datetime.utcnow() + d).strftime("%Y-%m-%dT%H:%M:%S")}
+                )
+            if not "status" in post_dictionary:
+                post_dictionary.update({"status": "enabled"})
+        elif url_pices[3] == "rules":
+            post_dictionary.update({"owner": url_pices[2]})
+            if not "status" in post_dictionary:
+                post_dictionary.update({"status": "enabled"})
+        elif url_pices[3] == "sensors":
+            if post_dictionary["modelid"] == "PHWA01":
+                post_dictionary.update({"state": {"status": 0}})
+        self._parent.bridge_config[url_pices[3]][str(i)] = post_dictionary
+        self._parent.state.touch(url_pices[3], str(i))
+        if url_pices[3] == "groups":
+            self._parent.rebuild_group_index()
+        if url_pices[3] == "schedules":
+            self._parent.schedules.update(str(i))
+        if url_pices[3] == "rules":
+            self._parent.rules.update(str(i))
+
+        return [{"success": {"id": str(i)}}]
+
+    def _update(self, url_pices, put_dictionary):
+        if len(url_pices) == 4:
+            self._parent.bridge_config[url_pices[3]].update(put_dictionary)
+            response_location = "/" + url_pices[3] + "/"
+        if len(url_pices) == 5:
+            if url_pices[3] == "schedules":
+                if (
+                    "status" in put_dictionary
+                    and put_dictionary["status"] == "enabled"
+                    and self._parent.bridge_config["schedules"][url_pices[4]][
+                        "localtime"
+                    ].startswith("PT")
+                ):
+                    if "localtime" in put_dictionary:
+                        timmer = put_dictionary["localtime"][2:]
+                    else:
+                        timmer = self._parent.bridge_config["schedules"][url_pices[4]][
+                            "localtime"
+                        ][2:]
+                    h, m, s = timmer.split(":")
+                    d = timedelta(hours=int(h), minutes=int(m), seconds=int(s))
+                    put_dictionary.update(
+                        {
+                            "starttime": (datetime.utcnow() + d).strftime(
+                                "%Y-%m-%dT%H:%M:%S"
+                            )
+                        }
+                    )
+            elif url_pices[3] == "scenes":
+                if "storelightstate" in put_dictionary:
+                    for light in self._parent.bridge_config["scenes"][url_pices[4]][
+                        "lightstates"
+                    ]:
+                        self._parent.bridge_config["scenes"][url_pices[4]][
+                            "lightstates"
+                        ][light]["on"] = self._parent.bridge_config["lights"][light][
+                            "state"
+                        ][
+                            "on"
+                        ]
+                        self._parent.bridge_config["scenes"][url_pices[4]][
+                            "lightstates"
+                        ][light]["bri"] = self._parent.bridge_config["lights"][light][
+                            "state"
+                        ][
+                            "bri"
+                        ]
+                        if (
+                            "xy"
+                            in self._parent.bridge_config["scenes"][url_pices[4]][
+                                "lightstates"
+                            ][light]
+                        ):
+                            del self._parent.bridge_config["scenes"][url_pices[4]][
+                                "lightstates"
+                            ][light]["xy"]
+                        elif (
+                            "ct"
+                            in self._parent.bridge_config["scenes"][url_pices[4]][
+                                "lightstates"
+                            ][light]
+                        ):
+                            del self._parent.bridge_config["scenes"][url_pices[4]][
+                                "lightstates"
+                            ][light]["ct"]
+                        elif (
+                            "hue"
+                            in self._parent.bridge_config["scenes"][url_pices[4]][
+                                "lightstates"
+                            ][light]
+                        ):
+                            del self._parent.bridge_config["scenes"][url_pices[4]][
+                                "lightstates"
+                            ][light]["hue"]
+                            del self._parent.bridge_config["scenes"][url_pices[4]][
+                                "lightstates"
+                            ][light]["sat"]
+                        if self._parent.bridge_config["lights"][light]["state"][
+                            "colormode"
+                        ] in [
+                            "ct",
+                            "xy",
+                        ]:
+                            self._parent.bridge_config["scenes"][url_pices[4]][
+                                "lightstates"
+                            ][light][
+                                self._parent.bridge_config["lights"][light]["state"][
+                                    "colormode"
+                                ]
+                            ] = self._parent.bridge_config[
+                                "lights"
+                            ][
+                                light
+                            ][
+                                "state"
+                            ][
+                                self._parent.bridge_config["lights"][light]["state"][
+                                    "colormode"
+                                ]
+                            ]
+                        elif (
+                            self._parent.bridge_config["lights"][light]["state"][
+                                "colormode"
+                            ]
+                            == "hs"
+                        ):
+                            self._parent.bridge_config["scenes"][url_pices[4]][
+                                "lightstates"
+                            ][light]["hue"] = self._parent.bridge_config["lights"][
+                                light
+                            ][
+                                "state"
+                            ][
+                                "hue"
+                            ]
+                            self._parent.bridge_config["scenes"][url_pices[4]][
+                                "lightstates"
+                            ][light]["sat"] = self._parent.bridge_config["lights"][
+                                light
+                            ][
+                                "state"
+                            ][
+                                "sat"
+                            ]
+
+            if url_pices[3] == "sensors":
+                for key, value in put_dictionary.items():
+                    self._parent.bridge_config[url_pices[3]][url_pices[4]][key].update(
+                        value
+                    )
+            else:
+                self._parent.bridge_config[url_pices[3]][url_pices[4]].update(
+                    put_dictionary
+                )
+            response_location = "/" + url_pices[3] + "/" + url_pices[4] + "/"
+        if len(url_pices) == 6:
+            if url_pices[3] == "groups":  # state is applied to a group
+                if (
+                    "scene" in put_dictionary
+                ):  # if group is 0 and there is a scene applied
+                    for light in self._parent.bridge_config["scenes"][
+                        put_dictionary["scene"]
+                    ]["lights"]:
+                        self._parent.bridge_config["lights"][light]["state"].update(
+                            self._parent.bridge_config["scenes"][
+                                put_dictionary["scene"]
+                            ]["lightstates"][light]
+                        )
+                        if (
+                            "xy"
+                            in self._parent.bridge_config["scenes"][
+                                put_dictionary["scene"]
+                            ]["lightstates"][light]
+                        ):
+                            self._parent.bridge_config["lights"][light]["state"][
+                                "colormode"
+                            ] = "xy"
+                        elif (
+                            "ct"
+                            in self._parent.bridge_config["scenes"][
+                                put_dictionary["scene"]
+                            ]["lightstates"][light]
+                        ):
+                            self._parent.bridge_config["lights"][light]["state"][
+                                "colormode"
+                            ] = "ct"
+                        elif (
+                            "hue"
+                            or "sat"
+                            in self._parent.bridge_config["scenes"][
+                                put_dictionary["scene"]
+                            ]["lightstates"][light]
+                        ):
+                            self._parent.bridge_config["lights"][light]["state"][
+                                "colormode"
+                            ] = "hs"
+                        self._parent.queue_light_request(
+                            light,
+                            self._parent.bridge_config["scenes"][
+                                put_dictionary["scene"]
+                            ]["lightstates"][light],
+                        )
+                        self._parent.state.touch("lights", light)
+                        self._parent.update_group_stats(light)
+                elif "bri_inc" in put_dictionary:
+                    self._parent.bridge_config["groups"][url_pices[4]]["action"][
+                        "bri"
+                    ] += int(put_dictionary["bri_inc"])
+                    if (
+                        self._parent.bridge_config["groups"][url_pices[4]]["action"][
+                            "bri"
+                        ]
+                        > 254
+                    ):
+                        self._parent.bridge_config["groups"][url_pices[4]]["action"][
+                            "bri"
+                        ] = 254
+                    elif (
+                        self._parent.bridge_config["groups"][url_pices[4]]["action"][
+                            "bri"
+                        ]
+                        < 1
+                    ):
+                        self._parent.bridge_config["groups"][url_pices[4]]["action"][
+                            "bri"
+                        ] = 1
+                    self._parent.bridge_config["groups"][url_pices[4]]["state"][
+                        "bri"
+                    ] = self._parent.bridge_config["groups"][url_pices[4]]["action"][
+                        "bri"
+                    ]
+                    del put_dictionary["bri_inc"]
+                    put_dictionary.update(
+                        {
+                            "bri": self._parent.bridge_config["groups"][url_pices[4]][
+                                "action"
+                            ]["bri"]
+                        }
+                    )
+                    for light in self._parent.bridge_config["groups"][url_pices[4]][
+                        "lights"
+                    ]:
+                        self._parent.bridge_config["lights"][light]["state"].update(
+                            put_dictionary
+                        )
+                        self._parent.state.touch("lights", light)
+                        self._parent.queue_light_request(light, put_dictionary)
+                        self._parent.update_group_stats(light)
+                elif url_pices[4] == "0":
+                    for light in self._parent.bridge_config["lights"].keys():
+                        self._parent.bridge_config["lights"][light]["state"].update(
+                            put_dictionary
+                        )
+                        self._parent.state.touch("lights", light)
+                        self._parent.queue_light_request(light, put_dictionary)
+                    for group in self._parent.bridge_config["groups"].keys():
+                        self._parent.bridge_config["groups"][group][
+                            url_pices[5]
+                        ].update(put_dictionary)
+                        self._parent.state.touch("groups", group)
+                    for light in self._parent.bridge_config["lights"].keys():
+                        self._parent.update_group_stats(light)
+                else:  # the state is applied to particular group (url_pices[4])
+                    for light in self._parent.bridge_config["groups"][url_pices[4]][
+                        "lights"
+                    ]:
+                        self._parent.bridge_config["lights"][light]["state"].update(
+                            put_dictionary
+                        )
+                        self._parent.state.touch("lights", light)
+                        self._parent.queue_light_request(light, put_dictionary)
+                        self._parent.update_group_stats(light)
+            elif url_pices[3] == "lights":  # state is applied to a light
+                self._parent.queue_light_request(url_pices[4], put_dictionary)
+                for key in put_dictionary.keys():
+                    if key in ["ct", "xy"]:  # colormode must be set by bridge
+                        self._parent.bridge_config["lights"][url_pices[4]]["state"][
+                            "colormode"
+                        ] = key
+                    elif key in ["hue", "sat"]:
+                        self._parent.bridge_config["lights"][url_pices[4]]["state"][
+                            "colormode"
+                        ] = "hs"
+            if (
+                not url_pices[4] == "0"
+            ):  # group 0 is virtual, must not be saved in bridge configuration
+                try:
+                    self._parent.bridge_config[url_pices[3]][url_pices[4]][
+                        url_pices[5]
+                    ].update(put_dictionary)
+                except KeyError:
+                    self._parent.bridge_config[url_pices[3]][url_pices[4]][
+                        url_pices[5]
+                    ] = put_dictionary
+            if url_pices[3] == "lights":
+                self._parent.update_group_stats(url_pices[4])
+            if url_pices[3] == "sensors":
+                self._parent.publish_change(
+                    "sensors", url_pices[4], url_pices[5], put_dictionary
+                )
+            response_location = (
+                "/" + url_pices[3] + "/" + url_pices[4] + "/" + url_pices[5] + "/"
+            )
+        if len(url_pices) == 7:
+            try:
+                self._parent.bridge_config[url_pices[3]][url_pices[4]][url_pices[5]][
+                    url_pices[6]
+                ].update(put_dictionary)
+            except KeyError:
+                self._parent.bridge_config[url_pices[3]][url_pices[4]][url_pices[5]][
+                    url_pices[6]
+                ] = put_dictionary
+            self._parent.bridge_config[url_pices[3]][url_pices[4]][url_pices[5]][
+                url_pices[6]
+            ] = put_dictionary
+            response_location = (
+                "/"
+                + url_pices[3]
+                + "/"
+                + url_pices[4]
+                + "/"
+                + url_pices[5]
+                + "/"
+                + url_pices[6]
+                + "/"
+            )
+        self._parent.state.touch(
+            url_pices[3], url_pices[4] if len(url_pices) > 4 else None
+        )
+        if url_pices[3] in ["lights", "groups"] and (
+            len(url_pices) == 4 or "lights" in put_dictionary
+        ):
+            self._parent.rebuild_group_index()
+        if url_pices[3] == "schedules" and len(url_pices) > 4:
+            self._parent.schedules.update(url_pices[4])
+        if url_pices[3] == "rules" and len(url_pices) > 4:
+            self._parent.rules.update(url_pices[4])
+        response_dictionary = []
+        for key, value in put_dictionary.items():
+            response_dictionary.append({"success": {response_location + key: value}})
+
+        return response_dictionary
+
+    def _delete(self, url_pices):
+        del self._parent.bridge_config[url_pices[3]][url_pices[4]]
+        self._parent.state.touch(url_pices[3], url_pices[4])
+        if url_pices[3] in ["lights", "groups"]:
+            self._parent.rebuild_group_index()
+        if url_pices[3] == "lights":
+            self._parent.transitions.cancel(url_pices[4])
+            self._parent.effects.stop(url_pices[4])
+        if url_pices[3] == "schedules":
+            self._parent.schedules.update(url_pices[4])
+        if url_pices[3] == "rules":
+            self._parent.rules.update(url_pices[4])
+
+        return [{"success": "/" + url_pices[3] + "/" + url_pices[4] + " deleted."}]
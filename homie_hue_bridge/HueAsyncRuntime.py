@@ -0,0 +1,278 @@
+import time
+import asyncio
+import logging
+from io import BytesIO
+
+from paho.mqtt.client import MQTT_ERR_NO_CONN
+
+from homie_hue_bridge.HueSSDP import SSDP_ADDR, SSDP_PORT
+from homie_hue_bridge.HueHTTPServer import HueHTTPServer
+
+logger = logging.getLogger(__name__)
+
+
+class BufferedHueHTTPServer(HueHTTPServer):
+    # Runs the normal request handler against a fully read request held in
+    # memory so that it can be driven from the event loop
+    def __init__(self, request, client_address, server):
+        self.response_delay = 0
+        self.event_subscriber = None
+        super().__init__(request, client_address, server)
+
+    def setup(self):
+        self.rfile = BytesIO(self.request)
+        self.wfile = BytesIO()
+
+    def handle(self):
+        # One request, the connection is kept open by AsyncHTTPServer
+        self.close_connection = True
+        self.handle_one_request()
+
+    def finish(self):
+        pass
+
+    def _delay_response(self, seconds):
+        self.response_delay = seconds
+
+    def _stream_events(self, subscriber):
+        self.event_subscriber = subscriber
+
+
+class AsyncHTTPServer:
+    max_header_size = 65536
+
+    def __init__(self, bridge):
+        self._bridge = bridge
+        self._port = bridge.port
+        self._server = None
+
+    async def start(self):
+        self._server = await asyncio.start_server(
+            self._handle_client, "", self._port, limit=self.max_header_size
+        )
+        logger.info("Starting async httpd on %d...", self._port)
+
+    async def stop(self):
+        if self._server:
+            self._server.close()
+            await self._server.wait_closed()
+
+    @staticmethod
+    def _content_length(head):
+        for line in head.split(b"\r\n")[1:]:
+            name, _, value = line.partition(b":")
+            if name.strip().lower() == b"content-length":
+                return int(value.strip() or 0)
+
+        return 0
+
+    async def _handle_client(self, reader, writer):
+        peer = writer.get_extra_info("peername")
+        try:
+            while True:
+                head = await asyncio.wait_for(
+                    reader.readuntil(b"\r\n\r\n"), HueHTTPServer.timeout
+                )
+                length = self._content_length(head)
+                body = await reader.readexactly(length) if length else b""
+
+                handler = BufferedHueHTTPServer(head + body, peer, self)
+                if handler.response_delay:
+                    await asyncio.sleep(handler.response_delay)
+
+                writer.write(handler.wfile.getvalue())
+                await writer.drain()
+
+                if handler.event_subscriber:
+                    await self._stream_events(handler.event_subscriber, writer)
+
+                if handler.close_connection:
+                    break
+
+        except (asyncio.IncompleteReadError, asyncio.LimitOverrunError, ValueError):
+            pass
+
+        except asyncio.TimeoutError:
+            logger.debug("Closing idle connection from %s", peer)
+
+        except ConnectionError:
+            logger.debug("Connection from %s dropped", peer)
+
+        except asyncio.CancelledError:
+            # Server shutting down with the connection still open
+            pass
+
+        finally:
+            writer.close()
+
+    async def _stream_events(self, subscriber, writer):
+        loop = asyncio.get_running_loop()
+        ready = asyncio.Event()
+        subscriber.on_ready = lambda: loop.call_soon_threadsafe(ready.set)
+        events = self._bridge.events
+        try:
+            while True:
+                try:
+                    await asyncio.wait_for(ready.wait(), events.keepalive)
+                except asyncio.TimeoutError:
+                    pass
+
+                ready.clear()
+                writer.write(events.format(subscriber.drain()))
+                await writer.drain()
+
+        finally:
+            events.unsubscribe(subscriber)
+
+
+class SSDPSearchProtocol(asyncio.DatagramProtocol):
+    def __init__(self, ssdp, loop):
+        self._ssdp = ssdp
+        self._loop = loop
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, address):
+        if self._ssdp.is_discover(data):
+            self._loop.call_later(self._ssdp.response_delay(), self._respond, address)
+
+    def _respond(self, address):
+        logger.debug("Sending M-Search response to %s", address[0])
+        for response in self._ssdp.search_responses():
+            self.transport.sendto(response, address)
+
+
+class AsyncSSDP:
+    def __init__(self, ssdp):
+        self._ssdp = ssdp
+        self._transports = []
+        self._broadcast_task = None
+
+    async def start(self, loop):
+        search, _ = await loop.create_datagram_endpoint(
+            lambda: SSDPSearchProtocol(self._ssdp, loop),
+            sock=self._ssdp.search_socket(),
+        )
+        broadcast, _ = await loop.create_datagram_endpoint(
+            asyncio.DatagramProtocol, sock=self._ssdp.broadcast_socket()
+        )
+        self._transports = [search, broadcast]
+        self._broadcast_task = loop.create_task(self._broadcast(broadcast))
+        logger.info("Starting async ssdp...")
+
+    async def _broadcast(self, transport):
+        while True:
+            for message in self._ssdp.notify_messages():
+                transport.sendto(message, (SSDP_ADDR, SSDP_PORT))
+            await asyncio.sleep(self._ssdp.broadcast_interval)
+
+    def stop(self):
+        if self._broadcast_task:
+            self._broadcast_task.cancel()
+
+        for transport in self._transports:
+            transport.close()
+
+
+class MQTTLoopAdapter:
+    # Drives a paho client from the event loop rather than its own network
+    # thread (see paho examples/loop_asyncio.py)
+    reconnect_interval = 5
+
+    def __init__(self, client):
+        self._client = client
+        self._loop = None
+        self._misc_task = None
+
+    def attach(self, loop):
+        self._loop = loop
+        if getattr(self._client, "_thread", None) is not None:
+            self._client.loop_stop()
+
+        self._client.on_socket_open = self._on_socket_open
+        self._client.on_socket_close = self._on_socket_close
+        self._client.on_socket_register_write = self._on_socket_register_write
+        self._client.on_socket_unregister_write = self._on_socket_unregister_write
+
+        sock = self._client.socket()
+        if sock:
+            self._on_socket_open(self._client, None, sock)
+            if self._client.want_write():
+                self._on_socket_register_write(self._client, None, sock)
+
+        self._misc_task = loop.create_task(self._misc())
+
+    def detach(self):
+        if self._misc_task:
+            self._misc_task.cancel()
+
+        sock = self._client.socket()
+        if sock:
+            self._loop.remove_reader(sock)
+            self._loop.remove_writer(sock)
+
+    def _on_socket_open(self, client, userdata, sock):
+        self._loop.call_soon_threadsafe(self._loop.add_reader, sock, client.loop_read)
+
+    def _on_socket_close(self, client, userdata, sock):
+        self._loop.call_soon_threadsafe(self._loop.remove_reader, sock)
+
+    def _on_socket_register_write(self, client, userdata, sock):
+        self._loop.call_soon_threadsafe(self._loop.add_writer, sock, client.loop_write)
+
+    def _on_socket_unregister_write(self, client, userdata, sock):
+        self._loop.call_soon_threadsafe(self._loop.remove_writer, sock)
+
+    async def _misc(self):
+        last_reconnect = 0
+        while True:
+            if self._client.loop_misc() == MQTT_ERR_NO_CONN:
+                if time.monotonic() - last_reconnect > self.reconnect_interval:
+                    last_reconnect = time.monotonic()
+                    try:
+                        await self._loop.run_in_executor(None, self._client.reconnect)
+                    except OSError as e:
+                        logger.warning("MQTT reconnect failed: %s", e)
+
+            await asyncio.sleep(1)
+
+
+class HueAsyncRuntime:
+    # Hosts the hue http api, ssdp, the scheduler and mqtt traffic on a
+    # single event loop
+    def __init__(self, bridge, ssdp, mqtt=None):
+        self._bridge = bridge
+        self._http = AsyncHTTPServer(bridge)
+        self._ssdp = AsyncSSDP(ssdp)
+        self._mqtt = MQTTLoopAdapter(mqtt) if mqtt else None
+        self._stopped = None
+        self._loop = None
+
+    async def run(self):
+        self._loop = asyncio.get_running_loop()
+        self._stopped = asyncio.Event()
+
+        self._bridge.attach_loop(self._loop)
+        await self._http.start()
+        await self._ssdp.start(self._loop)
+        if self._bridge.entertainment:
+            await self._bridge.entertainment.start_async(self._loop)
+        if self._mqtt:
+            self._mqtt.attach(self._loop)
+
+        try:
+            await self._stopped.wait()
+
+        finally:
+            if self._bridge.entertainment:
+                self._bridge.entertainment.stop()
+            if self._mqtt:
+                self._mqtt.detach()
+            self._ssdp.stop()
+            await self._http.stop()
+
+    def stop(self):
+        if self._loop:
+            self._loop.call_soon_threadsafe(self._stopped.set)
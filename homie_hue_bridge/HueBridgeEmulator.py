@@ -1,11 +1,9 @@
 #!/usr/bin/python
-import os
 import time
 import json
 import socket
 import random
-from http.server import HTTPServer
-from datetime import datetime, timedelta
+from datetime import datetime
 from threading import Thread
 from collections import defaultdict
 from uuid import getnode as get_mac
@@ -14,7 +12,21 @@ import logging
 import requests
 
 from homie_hue_bridge.HueSSDP import SSDP
-from homie_hue_bridge.HueHTTPServer import HueHTTPServer
+from homie_hue_bridge.HueHTTPServer import HueHTTPServer, ThreadingHTTPServer
+from homie_hue_bridge.HueAPI import HueAPI
+from homie_hue_bridge.HueEventStream import HueEventStream
+from homie_hue_bridge.HueEntertainment import HueEntertainment
+from homie_hue_bridge.HueTimers import TimerQueue, Ticker
+from homie_hue_bridge.HueDispatcher import HueDispatcher
+from homie_hue_bridge.HueGroupIndex import HueGroupIndex
+from homie_hue_bridge.HueStateStore import HueStateStore
+from homie_hue_bridge.HuePersistence import HuePersistence
+from homie_hue_bridge.HueJournal import HueJournal
+from homie_hue_bridge.HueDeviceCatalog import HueDeviceCatalog
+from homie_hue_bridge.HueTransitions import HueTransitions
+from homie_hue_bridge.HueEffects import HueEffects
+from homie_hue_bridge.HueSchedules import HueSchedules
+from homie_hue_bridge.HueRules import HueRules
 
 
 logger = logging.getLogger(__name__)
@@ -41,14 +53,45 @@ def get_unique_id():
 class HueBridgeEmulator:
     run_service = True
     _light_request_callbacks = []
-
-    def __init__(self, ip, port, mac, config_file="config.json"):
+    _stream_callbacks = []
+
+    def __init__(
+        self,
+        ip,
+        port,
+        mac,
+        config_file="config.json",
+        workers=4,
+        device_types=None,
+        journal=False,
+    ):
         self._ip = ip
         self._port = port
         self._mac = mac
         self._config_file = config_file
-
-        self.sensors_state = {}
+        self._loop = None
+        self._started = False
+
+        self.events = HueEventStream()
+        self.timers = TimerQueue()
+        self.dispatcher = HueDispatcher(workers)
+        self.api = HueAPI(self)
+        self.session = requests.Session()
+        self.session.mount(
+            "http://", requests.adapters.HTTPAdapter(pool_maxsize=workers)
+        )
+        self.entertainment = None
+        self.ticker = Ticker(self.timers)
+        self.transitions = HueTransitions(self.ticker, self.queue_light_frames)
+        self.effects = HueEffects(
+            self.ticker, self.queue_light_frames, self._alert_finished
+        )
+        self.device_types = HueDeviceCatalog(device_types)
+        self._metrics_providers = {
+            "dispatcher": self.dispatcher.stats,
+            "transitions": self.transitions.stats,
+            "effects": self.effects.stats,
+        }
         self.bridge_config = defaultdict(lambda: defaultdict(str))
 
         # load config files
@@ -59,7 +102,11 @@ class HueBridgeEmulator:
         except Exception:
             logger.exception("Config file was not loaded")
 
-        self.generate_sensors_state()
+        self.journal = None
+        if journal:
+            replayed = HueJournal.replay(f"{config_file}.journal", self.bridge_config)
+            logger.info("Replayed %d journal records", replayed)
+            self.journal = HueJournal(f"{config_file}.journal")
 
         self.bridge_config["config"]["ipaddress"] = self._ip
         self.bridge_config["config"]["mac"] = (
@@ -83,340 +130,306 @@ class HueBridgeEmulator:
         )
         self.bridge_config["config"]["bridgeid"] = mac.upper()
 
+        self.state = HueStateStore(self.bridge_config)
+        self.persistence = HuePersistence(
+            self.timers,
+            self.dispatcher,
+            self.state,
+            self._config_file,
+            self.journal,
+        )
+        self.state.add_listener(self.persistence.mark)
+        self._metrics_providers["persistence"] = self.persistence.stats
+        self.schedules = HueSchedules(
+            self.timers,
+            self.bridge_config["schedules"],
+            self.execute_schedule,
+            self._schedule_expired,
+        )
+        self.rules = HueRules(self.timers, self.bridge_config, self.execute_rule)
+        self._metrics_providers["rules"] = self.rules.stats
+        self._metrics_providers["routes"] = HueHTTPServer.routes.stats
+        self.group_index = HueGroupIndex()
+        self.rebuild_group_index()
+        for lid, light in self.bridge_config["lights"].items():
+            self.transitions.sent(lid, light["state"])
+
+    @property
+    def port(self):
+        return self._port
+
+    def enable_entertainment(self, port=2100, dtls=True, max_rate=25):
+        self.entertainment = HueEntertainment(self, port, dtls, max_rate)
+        self.add_metrics_provider("entertainment", self.entertainment.stats)
+
     def start(self):
-        self._scheduler_thread = Thread(target=self.scheduler_processor)
-        self._scheduler_thread.start()
+        self._started = True
+        self.timers.start()
+        self.dispatcher.start()
+        if self.entertainment:
+            self.entertainment.start()
+        self._start_scheduler()
 
         HueHTTPServer.set_parent(self)
-        self.httpd = HTTPServer(("", self._port), HueHTTPServer)
+        self.httpd = ThreadingHTTPServer(("", self._port), HueHTTPServer)
         logger.info("Starting httpd on %d..." % self._port)
         self._server_thread = Thread(target=self.httpd.serve_forever)
         self._server_thread.start()
 
+    def attach_loop(self, loop):
+        # Hand background work to an asyncio loop instead of threads, see
+        # HueAsyncRuntime
+        self._loop = loop
+        self.timers.attach_loop(loop)
+        self.dispatcher.start()
+        self._start_scheduler()
+        HueHTTPServer.set_parent(self)
+
     def shutdown(self):
         self.run_service = False
-        logger.info("Waiting for scheduler thread to end")
-        self._scheduler_thread.join()
+        if self.entertainment:
+            self.entertainment.stop()
 
-        self.httpd.shutdown()
-        self._server_thread.join()
+        if self._started:
+            self.httpd.shutdown()
+            self._server_thread.join()
+            self.timers.stop()
 
+        self.dispatcher.stop()
+        self.session.close()
         self.save_config()
         logger.info("Config saved")
+        if self.journal:
+            self.journal.close()
+
+    def run_task(self, fn, *args):
+        if self._loop:
+            self._loop.call_soon_threadsafe(fn, *args)
+        else:
+            Thread(target=fn, args=args).start()
+
+    def add_metrics_provider(self, name, fn):
+        self._metrics_providers[name] = fn
 
-    def generate_sensors_state(self):
-        for sensor in self.bridge_config["sensors"]:
-            if (
-                sensor not in self.sensors_state
-                and "state" in self.bridge_config["sensors"][sensor]
-            ):
-                self.sensors_state[sensor] = {"state": {}}
-                for key in self.bridge_config["sensors"][sensor]["state"].keys():
-                    if key in ["lastupdated", "presence", "flag", "dark", "status"]:
-                        self.sensors_state[sensor]["state"].update(
-                            {key: "2017-01-01T00:00:00"}
-                        )
+    def metrics(self):
+        return {name: fn() for name, fn in self._metrics_providers.items()}
 
     def get_devices(self):
         return self.bridge_config["lights"]
 
     def add_device(self, did, dtype, name):
-        device_db = None
+        device = self.device_types.instance(dtype)
+        device["name"] = name
+        device["uniqueid"] = get_unique_id()
 
-        with open(f"{os.path.dirname(__file__)}/data/device_types.json") as db_file:
-            device_db = json.load(db_file)
-
-        if device_db:
-            if dtype in device_db:
-                device = device_db[dtype]["data"]
-                device["name"] = name
-                device["uniqueid"] = get_unique_id()
-
-                self.bridge_config["lights"][did] = device
-                return device
-
-            else:
-                raise KeyError(f"Could not find device type {dtype}")
-
-        else:
-            raise OSError("Could not open device db")
+        with self.state.lock:
+            self.bridge_config["lights"][did] = device
+            self.transitions.sent(did, device["state"])
+            self.state.touch("lights", did)
+            self.rebuild_group_index()
+        return device
 
     def get_properties(self, dtype):
-        device_db = None
-
-        with open(f"{os.path.dirname(__file__)}/data/device_types.json") as db_file:
-            device_db = json.load(db_file)
-
-        if device_db:
-            if dtype in device_db:
-                return device_db[dtype]["properties"]
-
-            else:
-                raise KeyError(f"Could not find device type {dtype}")
-
-        else:
-            raise OSError("Could not open device db")
+        return self.device_types.properties(dtype)
 
     def remove_device(self, did):
-        if did in self.bridge_config["lights"]:
-            del self.bridge_config["lights"][did]
+        with self.state.lock:
+            if did in self.bridge_config["lights"]:
+                del self.bridge_config["lights"][did]
+                self.state.touch("lights", did)
+                self.rebuild_group_index()
+                self.transitions.cancel(did)
+                self.effects.stop(did)
 
-        else:
-            raise KeyError(f"No such device {did}")
+            else:
+                raise KeyError(f"No such device {did}")
 
     def save_config(self):
-        with open(self._config_file, "w") as fp:
-            json.dump(
-                self.bridge_config, fp, sort_keys=True, indent=4, separators=(",", ": ")
-            )
+        self.persistence.save()
+
+    def _start_scheduler(self):
+        self.schedules.load()
+        self.rules.load()
+
+    def execute_schedule(self, schedule):
+        self.queue_action(self.bridge_config["schedules"][schedule]["command"])
+
+    def _schedule_expired(self, schedule):
+        with self.state.lock:
+            if schedule in self.bridge_config["schedules"]:
+                self.bridge_config["schedules"][schedule]["status"] = "disabled"
+                self.state.touch("schedules", schedule)
+
+    def execute_rule(self, rule):
+        rule = self.bridge_config["rules"][rule]
+        for action in rule["actions"]:
+            self.queue_action(action, rule["owner"])
+
+    def publish_change(self, resource, rid, section, changes):
+        # Every state change goes through here, to the event stream and the
+        # rules depending on it
+        self.events.publish(resource, rid, section, changes)
+        self.rules.changed(resource, rid, section, changes)
+
+    def queue_action(self, action, owner=None):
+        address = action["address"]
+        if owner:
+            address = "/api/" + owner + address
+
+        self.dispatcher.submit(
+            (address, action["method"]), self._send_action, action["body"]
+        )
 
-    def scheduler_processor(self):
-        while self.run_service:
-            for schedule in self.bridge_config["schedules"].keys():
-                if self.bridge_config["schedules"][schedule]["status"] == "enabled":
-                    if self.bridge_config["schedules"][schedule][
-                        "localtime"
-                    ].startswith("W"):
-                        pices = self.bridge_config["schedules"][schedule][
-                            "localtime"
-                        ].split("/T")
-                        if int(pices[0][1:]) & (1 << 6 - datetime.today().weekday()):
-                            if pices[1] == datetime.now().strftime("%H:%M:%S"):
-                                logger.info("Execute schedule: %s", schedule)
-                                self.send_request(
-                                    self.bridge_config["schedules"][schedule][
-                                        "command"
-                                    ]["address"],
-                                    self.bridge_config["schedules"][schedule][
-                                        "command"
-                                    ]["method"],
-                                    json.dumps(
-                                        self.bridge_config["schedules"][schedule][
-                                            "command"
-                                        ]["body"]
-                                    ),
-                                )
-                    elif self.bridge_config["schedules"][schedule][
-                        "localtime"
-                    ].startswith("PT"):
-                        if self.bridge_config["schedules"][schedule][
-                            "starttime"
-                        ] == datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S"):
-                            logger.info("Execute timer: %s", schedule)
-                            self.send_request(
-                                self.bridge_config["schedules"][schedule]["command"][
-                                    "address"
-                                ],
-                                self.bridge_config["schedules"][schedule]["command"][
-                                    "method"
-                                ],
-                                json.dumps(
-                                    self.bridge_config["schedules"][schedule][
-                                        "command"
-                                    ]["body"]
-                                ),
-                            )
-                            self.bridge_config["schedules"][schedule][
-                                "status"
-                            ] = "disabled"
-                    else:
-                        if self.bridge_config["schedules"][schedule][
-                            "localtime"
-                        ] == datetime.now().strftime("%Y-%m-%dT%H:%M:%S"):
-                            logger.info("Execute schedule: %s", schedule)
-                            self.send_request(
-                                self.bridge_config["schedules"][schedule]["command"][
-                                    "address"
-                                ],
-                                self.bridge_config["schedules"][schedule]["command"][
-                                    "method"
-                                ],
-                                json.dumps(
-                                    self.bridge_config["schedules"][schedule][
-                                        "command"
-                                    ]["body"]
-                                ),
-                            )
-            if (
-                datetime.now().strftime("%M:%S") == "00:00"
-            ):  # auto save configuration every hour
-                self.save_config()
-            self.rules_processor(True)
-            time.sleep(1)
-
-    def rules_processor(self, scheduler=False):
-        self.bridge_config["config"]["localtime"] = datetime.now().strftime(
-            "%Y-%m-%dT%H:%M:%S"
-        )  # required for operator dx to address /config/localtime
-        for rule in self.bridge_config["rules"].keys():
-            if self.bridge_config["rules"][rule]["status"] == "enabled":
-                execute = True
-                for condition in self.bridge_config["rules"][rule]["conditions"]:
-                    url_pices = condition["address"].split("/")
-                    if condition["operator"] == "eq":
-                        if condition["value"] == "true":
-                            if not self.bridge_config[url_pices[1]][url_pices[2]][
-                                url_pices[3]
-                            ][url_pices[4]]:
-                                execute = False
-                        elif condition["value"] == "false":
-                            if self.bridge_config[url_pices[1]][url_pices[2]][
-                                url_pices[3]
-                            ][url_pices[4]]:
-                                execute = False
-                        else:
-                            if not int(
-                                self.bridge_config[url_pices[1]][url_pices[2]][
-                                    url_pices[3]
-                                ][url_pices[4]]
-                            ) == int(condition["value"]):
-                                execute = False
-                    elif condition["operator"] == "gt":
-                        if not int(
-                            self.bridge_config[url_pices[1]][url_pices[2]][
-                                url_pices[3]
-                            ][url_pices[4]]
-                        ) > int(condition["value"]):
-                            execute = False
-                    elif condition["operator"] == "lt":
-                        if int(
-                            not self.bridge_config[url_pices[1]][url_pices[2]][
-                                url_pices[3]
-                            ][url_pices[4]]
-                        ) < int(condition["value"]):
-                            execute = False
-                    elif condition["operator"] == "dx":
-                        if not self.sensors_state[url_pices[2]][url_pices[3]][
-                            url_pices[4]
-                        ] == datetime.now().strftime("%Y-%m-%dT%H:%M:%S"):
-                            execute = False
-                    elif condition["operator"] == "ddx":
-                        if not scheduler:
-                            execute = False
-                        else:
-                            ddx_time = datetime.strptime(
-                                condition["value"], "PT%H:%M:%S"
-                            )
-                            if not (
-                                datetime.strptime(
-                                    self.sensors_state[url_pices[2]][url_pices[3]][
-                                        url_pices[4]
-                                    ],
-                                    "%Y-%m-%dT%H:%M:%S",
-                                )
-                                + timedelta(
-                                    hours=ddx_time.hour,
-                                    minutes=ddx_time.minute,
-                                    seconds=ddx_time.second,
-                                )
-                            ) == datetime.now().replace(microsecond=0):
-                                execute = False
-                    elif condition["operator"] == "in":
-                        periods = condition["value"].split("/")
-                        if condition["value"][0] == "T":
-                            timeStart = datetime.strptime(
-                                periods[0], "T%H:%M:%S"
-                            ).time()
-                            timeEnd = datetime.strptime(periods[1], "T%H:%M:%S").time()
-                            now_time = datetime.now().time()
-                            if timeStart < timeEnd:
-                                if not timeStart <= now_time <= timeEnd:
-                                    execute = False
-                            else:
-                                if not (timeStart <= now_time or now_time <= timeEnd):
-                                    execute = False
-
-                if execute:
-                    logger.info("rule %s is triggered", rule)
-                    for action in self.bridge_config["rules"][rule]["actions"]:
-                        Thread(
-                            target=self.send_request,
-                            args=[
-                                "/api/"
-                                + self.bridge_config["rules"][rule]["owner"]
-                                + action["address"],
-                                action["method"],
-                                json.dumps(action["body"]),
-                            ],
-                        ).start()
+    def _send_action(self, key, body):
+        address, method = key
+        if address.startswith("/api/"):
+            self.api.request(method, address, body)
+        else:
+            self.send_request(address, method, json.dumps(body))
 
     def send_request(self, url, method, data, timeout=3, delay=0):
+        # Actions for other hosts share a pooled keep-alive session
         if delay != 0:
             time.sleep(delay)
         if not url.startswith("http"):
-            url = "http://127.0.0.1" + url
+            url = f"http://127.0.0.1:{self._port}" + url
         head = {"Content-type": "application/json"}
         if method == "POST":
             if type(data) is dict:
-                response = requests.post(url, data=data)
+                response = self.session.post(url, data=data)
             else:
-                response = requests.post(
+                response = self.session.post(
                     url, data=bytes(data, "utf8"), timeout=timeout, headers=head
                 )
             return response.text
         elif method == "PUT":
-            response = requests.put(
+            response = self.session.put(
                 url, data=bytes(data, "utf8"), timeout=timeout, headers=head
             )
             return response.text
         elif method == "GET":
-            response = requests.get(url, timeout=timeout, headers=head)
+            response = self.session.get(url, timeout=timeout, headers=head)
             return response.text
 
     def add_light_callbacks(self, fn):
         if fn not in self._light_request_callbacks:
             self._light_request_callbacks.append(fn)
 
-    def send_light_request(self, light, data):
-        # print("Update light " + light + " with " + json.dumps(data))
+    def queue_light_request(self, light, data):
+        if "alert" in data or "effect" in data:
+            state = dict(self.bridge_config["lights"][light]["state"], **data)
+            if "alert" in data:
+                self.effects.alert(light, data["alert"], state)
+            if "effect" in data:
+                self.effects.colorloop(light, data["effect"] == "colorloop", state)
+
+        # Published as requested. Requests, fade and effect frames for a light
+        # share its dispatcher slot, which only ever holds what the device
+        # should be sent next
+        self.publish_change("lights", light, "state", data)
+        if data.get("transitiontime"):
+            self.transitions.start(light, data, data["transitiontime"] / 10)
+
+        else:
+            self.transitions.cancel(light)
+            self.dispatcher.submit(light, self.send_light_frame, data)
+
+    def queue_light_frames(self, frames):
+        self.dispatcher.submit_many(self.send_light_frame, frames)
+
+    def _alert_finished(self, light):
+        if light in self.bridge_config["lights"]:
+            self.set_light_state(light, "alert", "none")
+
+    def send_light_frame(self, light, data):
+        self.transitions.sent(light, data)
         for fn in self._light_request_callbacks:
-            fn(light, data.get("on"), data.get("ct"), data.get("bri"))
+            fn(light, data)
+
+    def add_stream_callbacks(self, fn):
+        if fn not in self._stream_callbacks:
+            self._stream_callbacks.append(fn)
+
+    def send_stream_frame(self, light, on, rgb, bri):
+        for fn in self._stream_callbacks:
+            fn(light, on, rgb, bri)
 
     def set_light_state(self, light, property, value):
-        self.bridge_config["lights"][light]["state"]
-        if self.bridge_config["lights"][light]:
-            if property in self.bridge_config["lights"][light]["state"]:
-                logger.info("Updating %s %s %s", light, property, value)
-                self.bridge_config["lights"][light]["state"][property] = value
-            else:
-                logger.warning(
-                    "Trying to update none existant light property: %s", property
-                )
+        with self.state.lock:
+            self.bridge_config["lights"][light]["state"]
+            if self.bridge_config["lights"][light]:
+                if property in self.bridge_config["lights"][light]["state"]:
+                    logger.info("Updating %s %s %s", light, property, value)
+                    self.bridge_config["lights"][light]["state"][property] = value
+                    if property in ["ct", "xy"]:
+                        self.bridge_config["lights"][light]["state"][
+                            "colormode"
+                        ] = property
+                    self.state.touch("lights", light)
+                    self.publish_change("lights", light, "state", {property: value})
+                    self.update_group_stats(light)
+                else:
+                    logger.warning(
+                        "Trying to update none existant light property: %s",
+                        property,
+                    )
 
-        else:
-            logger.warning("Trying to update none existant light: %s", light)
+            else:
+                logger.warning("Trying to update none existant light: %s", light)
 
     def get_configured_lights(self):
         ret = {}
-        for lid, light in self.bridge_config.get("lights", {}).items():
+        for lid, light in self.state.snapshot("lights").items():
             ret[lid] = {"name": light["name"], "on": light["state"]["on"]}
 
         return ret
 
+    def rebuild_group_index(self):
+        # Must be called when group membership or the set of lights changes
+        with self.state.lock:
+            self.group_index.rebuild(
+                self.bridge_config["lights"], self.bridge_config["groups"]
+            )
+            for gid, group in self.bridge_config["groups"].items():
+                group.setdefault("state", {}).update(
+                    self.group_index.group_state(gid)
+                )
+            self.state.touch("groups")
+
+    def group_zero(self):
+        return {
+            "name": "Group 0",
+            "lights": list(self.bridge_config["lights"].keys()),
+            "type": "LightGroup",
+            "state": self.group_index.group_state("0"),
+            "recycle": False,
+            "action": {},
+        }
+
     def update_group_stats(
         self, light
     ):  # set group stats based on lights status in that group
-        for group in self.bridge_config["groups"]:
-            if light in self.bridge_config["groups"][group]["lights"]:
-                for key, value in self.bridge_config["lights"][light]["state"].items():
+        with self.state.lock:
+            light_state = self.bridge_config["lights"][light]["state"]
+            for group in self.group_index.update_light(light, light_state):
+                if group == "0":  # virtual, not stored in bridge configuration
+                    continue
+
+                for key, value in light_state.items():
                     if key not in ["on", "reachable"]:
                         self.bridge_config["groups"][group]["action"][key] = value
-                any_on = False
-                all_on = True
-                bri = 0
-                for group_light in self.bridge_config["groups"][group]["lights"]:
-                    if self.bridge_config["lights"][light]["state"]["on"] == True:
-                        any_on = True
-                    else:
-                        all_on = False
-                    bri += self.bridge_config["lights"][light]["state"]["bri"]
-                avg_bri = bri / len(self.bridge_config["groups"][group]["lights"])
-                self.bridge_config["groups"][group]["state"] = {
-                    "any_on": any_on,
-                    "all_on": all_on,
-                    "bri": avg_bri,
-                    "lastupdated": datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S"),
-                }
+
+                self.bridge_config["groups"][group]["state"] = dict(
+                    self.group_index.group_state(group),
+                    lastupdated=datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S"),
+                )
+                self.state.touch("groups", group)
+                self.publish_change(
+                    "groups",
+                    group,
+                    "state",
+                    self.bridge_config["groups"][group]["state"],
+                )
 
     def scan_for_lights(self):  # scan for ESP8266 lights and strips
         logger.info(
@@ -0,0 +1,283 @@
+import math
+import colorsys
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+# Conversions between hue light state (xy, hue/sat, ct in mired) and rgb,
+# hsv or xy for homie. numpy is optional and only used by the *_many
+# functions, which convert many lights at once
+FORMATS = ["ct", "rgb", "hsv", "xy"]
+
+CT_MIN = 153
+CT_MAX = 500
+WHITE = (0.3227, 0.329)
+GAMUT_C = [[0.6915, 0.3083], [0.17, 0.7], [0.1532, 0.0475]]
+
+# Wide gamut rgb <=> XYZ
+XYZ_TO_RGB = [
+    [1.656492, -0.354851, -0.255038],
+    [-0.707196, 1.655397, 0.036152],
+    [0.051713, -0.121364, 1.011530],
+]
+RGB_TO_XYZ = [
+    [0.664511, 0.154324, 0.162028],
+    [0.283881, 0.668433, 0.047685],
+    [0.000088, 0.072310, 0.986039],
+]
+
+
+def _gamma(value):
+    if value <= 0.0031308:
+        return 12.92 * value
+
+    return 1.055 * pow(value, 1 / 2.4) - 0.055
+
+
+def _linear(value):
+    if value <= 0.04045:
+        return value / 12.92
+
+    return pow((value + 0.055) / 1.055, 2.4)
+
+
+def _kelvin_to_rgb(kelvin):
+    t = kelvin / 100
+    if t <= 66:
+        r = 255
+        g = 99.4708025861 * math.log(t) - 161.1195681661
+    else:
+        r = 329.698727446 * pow(t - 60, -0.1332047592)
+        g = 288.1221695283 * pow(t - 60, -0.0755148492)
+
+    if t >= 66:
+        b = 255
+    elif t <= 19:
+        b = 0
+    else:
+        b = 138.5177312231 * math.log(t - 10) - 305.0447927307
+
+    return tuple(int(min(max(c, 0), 255)) for c in (r, g, b))
+
+
+CT_RGB = [_kelvin_to_rgb(1000000 / ct) for ct in range(CT_MIN, CT_MAX + 1)]
+
+
+def clamp_ct(ct):
+    return min(max(int(ct), CT_MIN), CT_MAX)
+
+
+def ct_to_rgb(ct):
+    return CT_RGB[clamp_ct(ct) - CT_MIN]
+
+
+def xy_to_ct(x, y):
+    # McCamy's approximation
+    if y == 0.1858:
+        return CT_MAX
+
+    n = (x - 0.3320) / (0.1858 - y)
+    kelvin = 437 * n**3 + 3601 * n**2 + 6861 * n + 5517
+    return clamp_ct(1000000 / kelvin) if kelvin > 0 else CT_MAX
+
+
+def xy_to_rgb(x, y, bri=1.0):
+    if y == 0:
+        return (0, 0, 0)
+
+    X = bri / y * x
+    Z = bri / y * (1.0 - x - y)
+    rgb = [_gamma(r[0] * X + r[1] * bri + r[2] * Z) for r in XYZ_TO_RGB]
+    peak = max(rgb)
+    if peak > 1:
+        rgb = [v / peak for v in rgb]
+
+    return tuple(int(max(v, 0) * 255) for v in rgb)
+
+
+def rgb_to_xy(r, g, b):
+    linear = [_linear(c / 255) for c in (r, g, b)]
+    X, Y, Z = [sum(m * c for m, c in zip(row, linear)) for row in RGB_TO_XYZ]
+    total = X + Y + Z
+    if total == 0:
+        return WHITE
+
+    return (round(X / total, 4), round(Y / total, 4))
+
+
+def _closest_on_segment(x, y, a, b):
+    dx = b[0] - a[0]
+    dy = b[1] - a[1]
+    t = ((x - a[0]) * dx + (y - a[1]) * dy) / (dx * dx + dy * dy)
+    t = min(max(t, 0), 1)
+    return (a[0] + t * dx, a[1] + t * dy)
+
+
+def _cross(p, a, b):
+    return (b[0] - a[0]) * (p[1] - a[1]) - (b[1] - a[1]) * (p[0] - a[0])
+
+
+def clip_xy(x, y, gamut=None):
+    # Moves xy onto the nearest edge of the device gamut when outside it
+    r, g, b = gamut or GAMUT_C
+    signs = [_cross((x, y), r, g), _cross((x, y), g, b), _cross((x, y), b, r)]
+    if all(s >= 0 for s in signs) or all(s <= 0 for s in signs):
+        return (x, y)
+
+    points = [_closest_on_segment(x, y, p, q) for p, q in ((r, g), (g, b), (b, r))]
+    cx, cy = min(points, key=lambda p: (p[0] - x) ** 2 + (p[1] - y) ** 2)
+    return (round(cx, 4), round(cy, 4))
+
+
+def hs_to_rgb(hue, sat):
+    # hue 0-65535, sat 0-254 at full brightness
+    rgb = colorsys.hsv_to_rgb(hue / 65535, sat / 254, 1)
+    return tuple(int(round(c * 255)) for c in rgb)
+
+
+def rgb_to_hsv(r, g, b):
+    # homie hsv, hue 0-360 and saturation, value 0-100
+    h, s, v = colorsys.rgb_to_hsv(r / 255, g / 255, b / 255)
+    return (int(round(h * 360)), int(round(s * 100)), int(round(v * 100)))
+
+
+def hsv_to_rgb(h, s, v):
+    rgb = colorsys.hsv_to_rgb(h / 360, s / 100, v / 100)
+    return tuple(int(round(c * 255)) for c in rgb)
+
+
+def state_xy(state, gamut=None):
+    # The colour of a light state, following its colormode when set
+    mode = state.get("colormode")
+    if "xy" in state and mode in [None, "xy"]:
+        return clip_xy(*state["xy"], gamut)
+
+    if "hue" in state and "sat" in state and mode in [None, "hs"]:
+        return clip_xy(*rgb_to_xy(*hs_to_rgb(state["hue"], state["sat"])), gamut)
+
+    if "ct" in state:
+        return rgb_to_xy(*ct_to_rgb(state["ct"]))
+
+
+def state_ct(state):
+    mode = state.get("colormode")
+    if "ct" in state and mode in [None, "ct"]:
+        return clamp_ct(state["ct"])
+
+    xy = state_xy(state)
+    if xy:
+        return xy_to_ct(*xy)
+
+
+def state_rgb(state, gamut=None):
+    if "ct" in state and state.get("colormode") in [None, "ct"]:
+        return ct_to_rgb(state["ct"])
+
+    xy = state_xy(state, gamut)
+    if xy:
+        return xy_to_rgb(*xy)
+
+
+def from_state(state, fmt, gamut=None):
+    # Returns the colour of state in fmt, or None when state has none
+    if fmt == "ct":
+        return state_ct(state)
+
+    if fmt == "xy":
+        return state_xy(state, gamut)
+
+    rgb = state_rgb(state, gamut)
+    if rgb is None or fmt == "rgb":
+        return rgb
+
+    return rgb_to_hsv(*rgb)
+
+
+def from_rgb(rgb, fmt, gamut=None):
+    if fmt == "rgb":
+        return tuple(rgb)
+
+    if fmt == "hsv":
+        return rgb_to_hsv(*rgb)
+
+    xy = clip_xy(*rgb_to_xy(*rgb), gamut)
+    return xy_to_ct(*xy) if fmt == "ct" else xy
+
+
+def to_state(value, fmt, gamut=None):
+    # Parses a homie colour into (hue property, value)
+    if fmt == "ct":
+        return "ct", clamp_ct(float(value))
+
+    parts = [float(v) for v in value.split(",")]
+    if fmt == "xy":
+        if len(parts) != 2:
+            raise ValueError(f"Expected x,y not {value}")
+        return "xy", list(clip_xy(*parts, gamut))
+
+    if len(parts) != 3:
+        raise ValueError(f"Expected three components not {value}")
+
+    rgb = hsv_to_rgb(*parts) if fmt == "hsv" else parts
+    return "xy", list(clip_xy(*rgb_to_xy(*rgb), gamut))
+
+
+def hs_to_xy_many(hues, sats, gamut=None):
+    # Batched hs_to_rgb => rgb_to_xy => clip_xy
+    if numpy is None:
+        return [
+            clip_xy(*rgb_to_xy(*hs_to_rgb(h, s)), gamut) for h, s in zip(hues, sats)
+        ]
+
+    h = numpy.asarray(hues, dtype=float) / 65535 * 6
+    s = numpy.asarray(sats, dtype=float) / 254
+    sector = numpy.floor(h).astype(int) % 6
+    f = h - numpy.floor(h)
+    p = 1 - s
+    q = 1 - s * f
+    t = 1 - s * (1 - f)
+    one = numpy.ones_like(h)
+    rgb = numpy.stack(
+        [
+            numpy.choose(sector, [one, q, p, p, t, one]),
+            numpy.choose(sector, [t, one, one, q, p, p]),
+            numpy.choose(sector, [p, p, t, one, one, q]),
+        ],
+        axis=1,
+    )
+    rgb = numpy.round(rgb * 255) / 255
+    linear = numpy.where(rgb > 0.04045, ((rgb + 0.055) / 1.055) ** 2.4, rgb / 12.92)
+    xyz = linear @ numpy.array(RGB_TO_XYZ).T
+    total = xyz.sum(axis=1)
+    total[total == 0] = 1
+    xy = numpy.round(xyz[:, :2] / total[:, None], 4)
+    return [clip_xy(x, y, gamut) for x, y in xy.tolist()]
+
+
+def xy_to_rgb_many(xys, bri=None):
+    # Batched xy_to_rgb, bri is a sequence of 0-1 levels
+    if numpy is None:
+        return [
+            xy_to_rgb(x, y, 1.0 if bri is None else bri[i])
+            for i, (x, y) in enumerate(xys)
+        ]
+
+    xy = numpy.asarray(xys, dtype=float).reshape(-1, 2)
+    level = numpy.ones(len(xy)) if bri is None else numpy.asarray(bri, dtype=float)
+    y = numpy.where(xy[:, 1] == 0, 1, xy[:, 1])
+    xyz = numpy.stack(
+        [level / y * xy[:, 0], level, level / y * (1 - xy[:, 0] - xy[:, 1])], axis=1
+    )
+    rgb = xyz @ numpy.array(XYZ_TO_RGB).T
+    rgb = numpy.where(
+        rgb <= 0.0031308,
+        12.92 * rgb,
+        1.055 * numpy.power(numpy.maximum(rgb, 0), 1 / 2.4) - 0.055,
+    )
+    peak = rgb.max(axis=1)
+    rgb = rgb / numpy.where(peak > 1, peak, 1)[:, None]
+    rgb = (numpy.maximum(rgb, 0) * 255).astype(int)
+    rgb[xy[:, 1] == 0] = 0
+    return [tuple(c) for c in rgb.tolist()]
@@ -0,0 +1,58 @@
+import os
+import json
+import logging
+
+logger = logging.getLogger(__name__)
+
+PACKAGE_TYPES = f"{os.path.dirname(__file__)}/data/device_types.json"
+
+
+class HueDeviceCatalog:
+    # Device types parsed once from the package data and an optional user
+    # file, which can add or override types. Templates are kept serialised
+    # so each light record is an independent json.loads of its template
+    def __init__(self, user_types=None):
+        self._templates = {}
+        self._properties = {}
+
+        self.load(PACKAGE_TYPES)
+        if user_types and os.path.exists(user_types):
+            self.load(user_types)
+
+    def load(self, path):
+        with open(path) as fp:
+            device_db = json.load(fp)
+
+        if not isinstance(device_db, dict):
+            raise ValueError(f"Device types in {path} should be an object")
+
+        for dtype, device_type in device_db.items():
+            self.add(dtype, device_type)
+
+        logger.info("Loaded %d device type(s) from %s", len(device_db), path)
+
+    def add(self, dtype, device_type):
+        data = device_type.get("data")
+        properties = device_type.get("properties")
+        if not isinstance(data, dict) or not isinstance(data.get("state"), dict):
+            raise ValueError(f"Device type {dtype} needs a data object with a state")
+
+        if not isinstance(properties, list) or not all(
+            isinstance(p, str) for p in properties
+        ):
+            raise ValueError(f"Device type {dtype} needs a list of properties")
+
+        self._templates[dtype] = json.dumps(data)
+        self._properties[dtype] = tuple(properties)
+
+    def instance(self, dtype):
+        if dtype not in self._templates:
+            raise KeyError(f"Could not find device type {dtype}")
+
+        return json.loads(self._templates[dtype])
+
+    def properties(self, dtype):
+        if dtype not in self._properties:
+            raise KeyError(f"Could not find device type {dtype}")
+
+        return list(self._properties[dtype])
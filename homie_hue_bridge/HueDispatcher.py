@@ -0,0 +1,106 @@
+import logging
+from threading import Thread, Condition
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+class HueDispatcher:
+    # Fixed pool of workers with one coalescing slot per key (i.e. light).
+    # Unsent data for a key is merged with newer data, and a key is never
+    # handled by two workers at once so updates to a device stay in order
+    def __init__(self, workers=4):
+        self._workers = workers
+        self._threads = []
+        self._running = False
+
+        self._pending = OrderedDict()
+        self._waiting = {}
+        self._inflight = set()
+        self._cond = Condition()
+
+        self.submitted = 0
+        self.coalesced = 0
+        self.dispatched = 0
+        self.failed = 0
+        self.max_depth = 0
+
+    def start(self):
+        if self._running:
+            return
+
+        self._running = True
+        for i in range(self._workers):
+            thread = Thread(target=self._work, name=f"dispatcher-{i}", daemon=True)
+            thread.start()
+            self._threads.append(thread)
+
+    def stop(self):
+        with self._cond:
+            self._running = False
+            self._cond.notify_all()
+
+        for thread in self._threads:
+            thread.join()
+        self._threads = []
+
+    def submit(self, key, fn, data):
+        with self._cond:
+            self._submit(key, fn, data)
+            self._cond.notify()
+
+    def submit_many(self, fn, items):
+        # items maps key => data, queued under one lock
+        with self._cond:
+            for key, data in items.items():
+                self._submit(key, fn, data)
+            self._cond.notify(len(items))
+
+    def _submit(self, key, fn, data):
+        self.submitted += 1
+        slots = self._waiting if key in self._inflight else self._pending
+        if key in slots:
+            self.coalesced += 1
+            slots[key][1].update(data)
+        else:
+            slots[key] = (fn, dict(data))
+
+        self.max_depth = max(self.max_depth, len(self._pending) + len(self._waiting))
+
+    def stats(self):
+        with self._cond:
+            return {
+                "workers": self._workers,
+                "depth": len(self._pending) + len(self._waiting),
+                "inflight": len(self._inflight),
+                "max_depth": self.max_depth,
+                "submitted": self.submitted,
+                "coalesced": self.coalesced,
+                "dispatched": self.dispatched,
+                "failed": self.failed,
+            }
+
+    def _work(self):
+        while True:
+            with self._cond:
+                while self._running and not self._pending:
+                    self._cond.wait()
+
+                if not self._pending:
+                    return
+
+                key, (fn, data) = self._pending.popitem(last=False)
+                self._inflight.add(key)
+
+            try:
+                fn(key, data)
+            except Exception:
+                logger.exception("Dispatching %s failed", key)
+                self.failed += 1
+
+            with self._cond:
+                self._inflight.discard(key)
+                self.dispatched += 1
+                if key in self._waiting:
+                    self._pending[key] = self._waiting.pop(key)
+                    self._cond.notify()
@@ -0,0 +1,110 @@
+import time
+from threading import Lock
+
+from homie_hue_bridge.HueColor import hs_to_xy_many
+
+
+class HueEffects:
+    # Alert blinks and colorloops rendered by the bridge. Every light is
+    # stepped from the shared ticker and a tick's frames are emitted together
+    blink_interval = 0.5
+    lselect_duration = 15
+    colorloop_period = 30
+    colorloop_rate = 2
+
+    def __init__(self, ticker, emit, finished):
+        self._ticker = ticker
+        self._emit = emit
+        self._finished = finished
+
+        self._alerts = {}
+        self._loops = {}
+        self._last_loop = 0
+        self._lock = Lock()
+
+        self.frames = 0
+
+    def stats(self):
+        return {
+            "alerts": len(self._alerts),
+            "colorloops": len(self._loops),
+            "frames": self.frames,
+        }
+
+    def alert(self, light, mode, state):
+        with self._lock:
+            if mode not in ["select", "lselect"]:
+                self._alerts.pop(light, None)
+                return
+
+            base = {k: state[k] for k in ["on", "bri"] if k in state}
+            duration = (
+                self.blink_interval * 2 if mode == "select" else self.lselect_duration
+            )
+            self._alerts[light] = [time.monotonic(), duration, base, None]
+
+        self._ticker.wake(self._tick)
+
+    def colorloop(self, light, enabled, state):
+        with self._lock:
+            if not enabled:
+                self._loops.pop(light, None)
+                return
+
+            if light not in self._loops:
+                self._loops[light] = (time.monotonic(), state.get("sat", 254))
+
+        self._ticker.wake(self._tick)
+
+    def stop(self, light):
+        with self._lock:
+            self._alerts.pop(light, None)
+            self._loops.pop(light, None)
+
+    def _tick(self, now):
+        frames = {}
+        finished = []
+        with self._lock:
+            for light, alert in list(self._alerts.items()):
+                started, duration, base, phase = alert
+                elapsed = now - started
+                if elapsed >= duration:
+                    del self._alerts[light]
+                    if phase:
+                        # Still blinked, the last phase otherwise restored it
+                        frames[light] = dict(base)
+                    finished.append(light)
+                    continue
+
+                blink = int(elapsed / self.blink_interval) % 2 == 0
+                if blink != phase:
+                    alert[3] = blink
+                    frames[light] = {"on": not base.get("on")} if blink else dict(base)
+
+            if self._loops and now - self._last_loop >= 1 / self.colorloop_rate:
+                self._last_loop = now
+                lights = list(self._loops.keys())
+                hues = []
+                sats = []
+                for light in lights:
+                    started, sat = self._loops[light]
+                    cycle = (now - started) / self.colorloop_period % 1
+                    hues.append(int(cycle * 65535))
+                    sats.append(sat)
+
+                xys = hs_to_xy_many(hues, sats)
+                for light, hue, sat, xy in zip(lights, hues, sats, xys):
+                    frames.setdefault(light, {}).update(
+                        {"hue": hue, "sat": sat, "xy": list(xy)}
+                    )
+
+            active = bool(self._alerts or self._loops)
+            self.frames += len(frames)
+
+        if frames:
+            self._emit(frames)
+
+        for light in finished:
+            self._finished(light)
+
+        return active
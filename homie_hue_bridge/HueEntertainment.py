@@ -0,0 +1,304 @@
+import time
+import socket
+import struct
+import asyncio
+import logging
+from threading import Thread, Lock
+
+from homie_hue_bridge.HueColor import xy_to_rgb_many
+
+logger = logging.getLogger(__name__)
+
+# Entertainment streaming protocol
+# https://developers.meethue.com/develop/hue-entertainment/hue-entertainment-api/
+HEADER = b"HueStream"
+HEADER_SIZE = 16
+CONFIG_ID_SIZE = 36
+V1_RECORD = struct.Struct(">BHHHH")
+V2_RECORD = struct.Struct(">BHHH")
+
+COLORSPACE_RGB = 0
+COLORSPACE_XY = 1
+
+PSK_CIPHER = "TLS-PSK-WITH-AES-128-GCM-SHA256"
+
+
+def decode_frame(data):
+    if len(data) < HEADER_SIZE or data[:9] != HEADER:
+        raise ValueError("Not a HueStream frame")
+
+    version = data[9]
+    colorspace = data[14]
+    channels = []
+    if version == 1:
+        for offset in range(
+            HEADER_SIZE, len(data) - V1_RECORD.size + 1, V1_RECORD.size
+        ):
+            rtype, channel, a, b, c = V1_RECORD.unpack_from(data, offset)
+            if rtype == 0:
+                channels.append((channel, a, b, c))
+
+    elif version == 2:
+        start = HEADER_SIZE + CONFIG_ID_SIZE
+        for offset in range(start, len(data) - V2_RECORD.size + 1, V2_RECORD.size):
+            channels.append(V2_RECORD.unpack_from(data, offset))
+
+    else:
+        raise ValueError(f"Unsupported HueStream version {version}")
+
+    return version, colorspace, channels
+
+
+def channel_colors(channels):
+    # Returns (on, (r, g, b), bri) for each (colorspace, a, b, c) with bri on
+    # the hue 1-254 scale. xy channels are converted together
+    xy = [
+        (a / 0xFFFF, b / 0xFFFF, c / 0xFFFF)
+        for colorspace, a, b, c in channels
+        if colorspace == COLORSPACE_XY
+    ]
+    rgbs = iter(xy_to_rgb_many([v[:2] for v in xy], [v[2] for v in xy]) if xy else [])
+
+    colors = []
+    for colorspace, a, b, c in channels:
+        if colorspace == COLORSPACE_XY:
+            level = c / 0xFFFF
+            rgb = next(rgbs)
+
+        else:
+            level = max(a, b, c) / 0xFFFF
+            rgb = (a >> 8, b >> 8, c >> 8)
+
+        colors.append((level > 0, rgb, int(round(level * 253)) + 1))
+
+    return colors
+
+
+class EntertainmentProtocol(asyncio.DatagramProtocol):
+    def __init__(self, entertainment):
+        self._entertainment = entertainment
+
+    def datagram_received(self, data, address):
+        self._entertainment.frame(data)
+
+
+class HueEntertainment:
+    session_timeout = 10
+
+    def __init__(self, bridge, port=2100, dtls=True, max_rate=25):
+        self._bridge = bridge
+        self._port = port
+        self._dtls = dtls
+        self.max_rate = max_rate
+
+        self._rates = {}
+        self._latest = {}
+        self._scheduled = {}
+        self._last_sent = {}
+        self._channel_map = (None, [])
+        self._known = (None, set())
+        self._lock = Lock()
+
+        self._running = False
+        self._thread = None
+        self._transport = None
+
+        self.frames = 0
+        self.invalid = 0
+        self.coalesced = 0
+        self.published = 0
+
+    def set_rate(self, light, rate):
+        self._rates[light] = float(rate)
+
+    def stats(self):
+        return {
+            "frames": self.frames,
+            "invalid": self.invalid,
+            "coalesced": self.coalesced,
+            "published": self.published,
+        }
+
+    def start(self):
+        self._running = True
+        self._thread = Thread(
+            target=self._serve_dtls if self._dtls else self._serve, daemon=True
+        )
+        self._thread.start()
+        logger.info(
+            "Starting %s entertainment stream on %d",
+            "dtls" if self._dtls else "plaintext",
+            self._port,
+        )
+
+    async def start_async(self, loop):
+        if self._dtls:
+            # mbedtls sockets are blocking, dtls sessions keep their thread
+            self.start()
+            return
+
+        self._transport, _ = await loop.create_datagram_endpoint(
+            lambda: EntertainmentProtocol(self), local_addr=("0.0.0.0", self._port)
+        )
+        logger.info("Starting async plaintext entertainment stream on %d", self._port)
+
+    def stop(self):
+        self._running = False
+        if self._transport:
+            self._transport.close()
+            self._transport = None
+
+        if self._thread:
+            self._thread.join()
+            self._thread = None
+
+    def _channel_lights(self):
+        # v2 frames address channels of the active entertainment group
+        version = self._bridge.state.resource_version("groups")
+        if self._channel_map[0] != version:
+            lights = []
+            for group in self._bridge.state.snapshot("groups").values():
+                if group.get("type") == "Entertainment" and group.get("stream", {}).get(
+                    "active"
+                ):
+                    lights = list(group["lights"])
+                    break
+
+            self._channel_map = (version, lights)
+
+        return self._channel_map[1]
+
+    def _known_lights(self):
+        version = self._bridge.state.resource_version("lights")
+        if self._known[0] != version:
+            with self._bridge.state.lock:
+                self._known = (version, set(self._bridge.bridge_config["lights"]))
+
+        return self._known[1]
+
+    def frame(self, data):
+        try:
+            version, colorspace, channels = decode_frame(data)
+        except (ValueError, struct.error) as e:
+            self.invalid += 1
+            logger.debug("Dropping entertainment frame: %s", e)
+            return
+
+        lights = self._channel_lights() if version == 2 else None
+        known = self._known_lights()
+        now = time.monotonic()
+        with self._lock:
+            self.frames += 1
+            for channel, a, b, c in channels:
+                if lights is not None:
+                    if channel >= len(lights):
+                        continue
+                    light = lights[channel]
+                else:
+                    light = str(channel)
+
+                if light not in known:
+                    continue
+
+                if light in self._latest:
+                    self.coalesced += 1
+                self._latest[light] = (colorspace, a, b, c)
+
+                if light not in self._scheduled:
+                    interval = 1 / self._rates.get(light, self.max_rate)
+                    due = max(now, self._last_sent.get(light, 0) + interval)
+                    self._scheduled[light] = due
+                    self._bridge.timers.call_at(due, self._flush, due)
+
+    def _flush(self, due):
+        # Sends every light due by then. Lights of a frame sharing a rate are
+        # due together, the first of their timers sends them all
+        with self._lock:
+            now = time.monotonic()
+            lights = [light for light, when in self._scheduled.items() if when <= due]
+            values = []
+            for light in lights:
+                del self._scheduled[light]
+                self._last_sent[light] = now
+                values.append(self._latest.pop(light))
+
+        if not lights:
+            return
+
+        self.published += len(lights)
+        for light, color in zip(lights, channel_colors(values)):
+            self._bridge.send_stream_frame(light, *color)
+
+    def _serve(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        sock.bind(("", self._port))
+        sock.settimeout(1)
+
+        while self._running:
+            try:
+                data, _ = sock.recvfrom(1024)
+            except socket.timeout:
+                continue
+
+            self.frame(data)
+
+        sock.close()
+
+    def _psk_store(self):
+        store = {}
+        whitelist = self._bridge.state.snapshot("config")["whitelist"]
+        for username, user in whitelist.items():
+            if user.get("clientkey"):
+                store[username] = bytes.fromhex(user["clientkey"])
+
+        return store
+
+    def _serve_dtls(self):
+        try:
+            from mbedtls import tls
+            from mbedtls.exceptions import TLSError
+        except ImportError:
+            logger.error("DTLS entertainment streaming requires python-mbedtls")
+            return
+
+        while self._running:
+            # Rebuilt per session so newly registered client keys are picked up
+            context = tls.ServerContext(
+                tls.DTLSConfiguration(
+                    pre_shared_key_store=self._psk_store(),
+                    ciphers=[PSK_CIPHER],
+                    validate_certificates=False,
+                )
+            )
+            sock = context.wrap_socket(socket.socket(socket.AF_INET, socket.SOCK_DGRAM))
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.bind(("", self._port))
+            sock.settimeout(1)
+            try:
+                conn, address = sock.accept()
+                conn.setcookieparam(address[0].encode("ascii"))
+                try:
+                    conn.do_handshake()
+                except tls.HelloVerifyRequest:
+                    conn, address = conn.accept()
+                    conn.setcookieparam(address[0].encode("ascii"))
+                    conn.do_handshake()
+
+                logger.info("Entertainment session from %s", address[0])
+                conn.settimeout(self.session_timeout)
+                while self._running:
+                    data = conn.recv(1024)
+                    if not data:
+                        break
+
+                    self.frame(data)
+
+            except socket.timeout:
+                pass
+
+            except (OSError, TLSError) as e:
+                logger.warning("Entertainment session ended: %s", e)
+
+            finally:
+                sock.close()
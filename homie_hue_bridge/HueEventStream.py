@@ -0,0 +1,105 @@
+import json
+import uuid
+import time
+import logging
+from datetime import datetime
+from threading import Condition, Lock
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+# Map v1 resources to their CLIP v2 event types
+EVENT_TYPES = {"lights": "light", "groups": "grouped_light", "sensors": "sensor"}
+
+
+class EventSubscriber:
+    # Pending events are keyed by resource so a slow client only ever holds
+    # the latest value for each, and at most max_pending resources
+    def __init__(self, max_pending=256):
+        self.max_pending = max_pending
+        self.dropped = 0
+        self.on_ready = None
+
+        self._pending = OrderedDict()
+        self._cond = Condition()
+
+    def push(self, id_v1, etype, section, changes):
+        with self._cond:
+            event = self._pending.get(id_v1)
+            if event is None:
+                if len(self._pending) >= self.max_pending:
+                    self._pending.popitem(last=False)
+                    self.dropped += 1
+
+                event = self._pending[id_v1] = {"id_v1": id_v1, "type": etype}
+
+            event.setdefault(section, {}).update(changes)
+            self._cond.notify()
+
+        if self.on_ready:
+            self.on_ready()
+
+    def drain(self):
+        with self._cond:
+            events = list(self._pending.values())
+            self._pending.clear()
+
+        return events
+
+    def wait(self, timeout):
+        with self._cond:
+            if not self._pending:
+                self._cond.wait(timeout)
+
+        return self.drain()
+
+
+class HueEventStream:
+    keepalive = 10
+
+    def __init__(self, max_pending=256):
+        self.max_pending = max_pending
+        self._subscribers = []
+        self._lock = Lock()
+        self._sequence = 0
+
+    def subscribe(self):
+        subscriber = EventSubscriber(self.max_pending)
+        with self._lock:
+            self._subscribers = self._subscribers + [subscriber]
+
+        logger.info("Event stream subscribed, %d active", len(self._subscribers))
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self._lock:
+            self._subscribers = [s for s in self._subscribers if s is not subscriber]
+
+        logger.info("Event stream unsubscribed, %d active", len(self._subscribers))
+
+    def publish(self, resource, rid, section, changes):
+        subscribers = self._subscribers
+        if not subscribers or not changes:
+            return
+
+        id_v1 = f"/{resource}/{rid}"
+        etype = EVENT_TYPES.get(resource, resource)
+        for subscriber in subscribers:
+            subscriber.push(id_v1, etype, section, changes)
+
+    def format(self, events):
+        if not events:
+            return b": hi\n\n"
+
+        self._sequence += 1
+        message = [
+            {
+                "creationtime": datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%SZ"),
+                "data": events,
+                "id": str(uuid.uuid4()),
+                "type": "update",
+            }
+        ]
+        return (
+            f"id: {int(time.time())}:{self._sequence}\ndata: {json.dumps(message)}\n\n"
+        ).encode("utf8")
@@ -0,0 +1,55 @@
+class HueGroupIndex:
+    # Reverse index from light to the groups containing it, with running on
+    # and brightness totals per group. Group 0 (all lights) is implicit
+    def __init__(self):
+        self._groups = {}
+        self._size = {}
+        self._on = {}
+        self._bri = {}
+        self._values = {}
+
+    @staticmethod
+    def _light_values(state):
+        return state.get("on") is True, state.get("bri", 0)
+
+    def rebuild(self, lights, groups):
+        self._groups = {lid: ["0"] for lid in lights}
+        self._size = {"0": len(lights)}
+        self._values = {lid: self._light_values(l["state"]) for lid, l in lights.items()}
+
+        for gid, group in groups.items():
+            members = [lid for lid in group.get("lights", []) if lid in lights]
+            self._size[gid] = len(members)
+            for lid in members:
+                self._groups[lid].append(gid)
+
+        self._on = {gid: 0 for gid in self._size}
+        self._bri = {gid: 0 for gid in self._size}
+        for lid, (on, bri) in self._values.items():
+            for gid in self._groups[lid]:
+                self._on[gid] += on
+                self._bri[gid] += bri
+
+    def update_light(self, light, state):
+        # Returns the groups containing light
+        if light not in self._groups:
+            return []
+
+        on, bri = self._light_values(state)
+        old_on, old_bri = self._values[light]
+        if (on, bri) != (old_on, old_bri):
+            self._values[light] = (on, bri)
+            for gid in self._groups[light]:
+                self._on[gid] += on - old_on
+                self._bri[gid] += bri - old_bri
+
+        return self._groups[light]
+
+    def group_state(self, gid):
+        size = self._size.get(gid, 0)
+        on = self._on.get(gid, 0)
+        return {
+            "any_on": on > 0,
+            "all_on": size > 0 and on == size,
+            "bri": self._bri.get(gid, 0) / size if size else 0,
+        }
@@ -1,658 +1,400 @@
 import time
 import hashlib
+import secrets
 import logging
 import json
-from threading import Thread
-from datetime import datetime, timedelta
+from datetime import datetime
+from urllib.parse import urlsplit, parse_qs
+from socketserver import ThreadingMixIn
 from http.server import BaseHTTPRequestHandler, HTTPServer
 
+from homie_hue_bridge.HueStateStore import ENCODINGS
+from homie_hue_bridge.HueRouter import (
+    HueRouter,
+    error,
+    UNAUTHORIZED_USER,
+    INVALID_JSON,
+    RESOURCE_NOT_AVAILABLE,
+    METHOD_NOT_AVAILABLE,
+    MISSING_PARAMETERS,
+    INVALID_VALUE,
+)
+
 logger = logging.getLogger(__name__)
 
+# Resources returned by the (non standard) /api/<user>/changes endpoint
+CHANGE_RESOURCES = ["lights", "groups", "sensors"]
+
+# Unknown users can still read the bridge config through these
+DISCOVERY_USERS = ["nouser", "config"]
+
+ROUTES = HueRouter()
+for method, pattern, handler in [
+    ("GET", "/", "_get_empty"),
+    ("GET", "/api", "_get_empty"),
+    ("GET", "/description.xml", "_get_description"),
+    ("GET", "/eventstream/clip/v2", "_event_stream"),
+    ("GET", "/api/{user}", "_get_all"),
+    ("GET", "/api/{user}/metrics", "_get_metrics"),
+    ("GET", "/api/{user}/changes", "_get_changes"),
+    ("GET", "/api/{user}/{resource:resource}", "_get_resource"),
+    ("GET", "/api/{user}/{resource:resource}/new", "_get_new"),
+    ("GET", "/api/{user}/groups/0", "_get_group_zero"),
+    ("GET", "/api/{user}/{resource:resource}/{key}", "_get_key"),
+    ("GET", "/api/{user}/{resource:resource}/{key}/{section}", "_get_key"),
+    ("POST", "/api", "_register"),
+    ("POST", "/api/{user}/{resource:resource}", "_create"),
+    ("PUT", "/api/{user}/{resource:resource}", "_update"),
+    ("PUT", "/api/{user}/{resource:resource}/{key}", "_update"),
+    ("PUT", "/api/{user}/{resource:resource}/{key}/{section}", "_update"),
+    ("PUT", "/api/{user}/{resource:resource}/{key}/{section}/{field}", "_update"),
+    ("DELETE", "/api/{user}/{resource:resource}/{key}", "_delete"),
+]:
+    ROUTES.add(method, pattern, handler)
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    # Long lived event stream connections must not block other clients
+    daemon_threads = True
+
 
 class HueHTTPServer(BaseHTTPRequestHandler):
+    # Persistent connections, closed after timeout seconds idle
+    protocol_version = "HTTP/1.1"
+    timeout = 30
+    disable_nagle_algorithm = True
+
+    # State responses at least this large are compressed when accepted
+    compress_size = 1024
+
+    routes = ROUTES
+
     @staticmethod
     def set_parent(parent):
         HueHTTPServer._parent = parent
 
-    def _set_headers(self):
+    def _delay_response(self, seconds):
+        time.sleep(seconds)
+
+    def _send(
+        self,
+        body=b"",
+        etag=None,
+        content_type="application/json",
+        encoding=None,
+        vary=False,
+    ):
+        # The body is complete before the headers go out so it can be sized
         self.send_response(200)
-        self.send_header("Content-type", "text/html")
+        self.send_header("Content-Type", content_type)
+        if encoding:
+            self.send_header("Content-Encoding", encoding)
+        self.send_header("Content-Length", str(len(body)))
+        if etag:
+            self.send_header("ETag", etag)
+        if vary:
+            self.send_header("Vary", "Accept-Encoding")
         self.end_headers()
+        self.wfile.write(body)
 
-    def do_GET(self):
-        self._set_headers()
-        if self.path == "/description.xml":
-            self.wfile.write(bytes(self._parent.description(), "utf8"))
-        else:
-            url_pices = self.path.split("/")
-            logger.info(url_pices)
-            if len(url_pices) < 3:
+    def _send_state(self, resource, etag):
+        # resource None for the whole state, compressed if the client accepts
+        # it and it is large enough
+        state = self._parent.state
+        encoding = self._encoding()
+        if encoding:
+            body = state.compressed(resource, encoding, self.compress_size)
+            if body is not None:
+                self._send(body, etag, encoding=encoding, vary=True)
                 return
 
-            if (
-                url_pices[2] in self._parent.bridge_config["config"]["whitelist"]
-            ):  # if username is in whitelist
-                self._parent.bridge_config["config"][
-                    "UTC"
-                ] = datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S")
-                self._parent.bridge_config["config"][
-                    "localtime"
-                ] = datetime.now().strftime("%Y-%m-%dT%H:%M:%S")
-                if len(url_pices) == 3:  # print entire config
-                    self.wfile.write(
-                        json.dumps(self._parent.bridge_config).encode("utf8")
-                    )
-                elif len(url_pices) == 4:  # print specified object config
-                    self.wfile.write(
-                        json.dumps(self._parent.bridge_config[url_pices[3]]).encode(
-                            "utf8"
-                        )
-                    )
-                elif len(url_pices) == 5:
-                    if url_pices[4] == "new":  # return new lights and sensors only
-                        self.wfile.write(
-                            json.dumps(
-                                {
-                                    "lastscan": datetime.now().strftime(
-                                        "%Y-%m-%dT%H:%M:%S"
-                                    )
-                                }
-                            ).encode("utf8")
-                        )
-                    else:
-                        self.wfile.write(
-                            json.dumps(
-                                self._parent.bridge_config[url_pices[3]][url_pices[4]]
-                            ).encode("utf8")
-                        )
-                elif len(url_pices) == 6:
-                    self.wfile.write(
-                        json.dumps(
-                            self._parent.bridge_config[url_pices[3]][url_pices[4]][
-                                url_pices[5]
-                            ]
-                        ).encode("utf8")
-                    )
-            elif (
-                url_pices[2] == "nouser" or url_pices[2] == "config"
-            ):  # used by applications to discover the bridge
-                self.wfile.write(
-                    json.dumps(
-                        {
-                            "name": self._parent.bridge_config["config"]["name"],
-                            "datastoreversion": 59,
-                            "swversion": self._parent.bridge_config["config"][
-                                "swversion"
-                            ],
-                            "apiversion": self._parent.bridge_config["config"][
-                                "apiversion"
-                            ],
-                            "mac": self._parent.bridge_config["config"]["mac"],
-                            "bridgeid": self._parent.bridge_config["config"][
-                                "bridgeid"
-                            ],
-                            "factorynew": False,
-                            "modelid": self._parent.bridge_config["config"]["modelid"],
-                        }
-                    ).encode("utf8")
-                )
-            else:  # user is not in whitelist
-                self.wfile.write(
-                    json.dumps(
-                        [
-                            {
-                                "error": {
-                                    "type": 1,
-                                    "address": self.path,
-                                    "description": "unauthorized user",
-                                }
-                            }
-                        ]
-                    ).encode("utf8")
-                )
+        if resource is None:
+            self._send(state.serialized_all(), etag, vary=True)
+        else:
+            self._send(state.serialized(resource), etag, vary=True)
 
-    def do_POST(self):
-        self._set_headers()
-        # print("in post method")
-        self.data_string = self.rfile.read(int(self.headers["Content-Length"]))
-        post_dictionary = json.loads(self.data_string)
-        url_pices = self.path.split("/")
-        # print(self.path)
-        # print(self.data_string)
-        if len(url_pices) == 4:  # data was posted to a location
-            if url_pices[2] in self._parent.bridge_config["config"]["whitelist"]:
-                if (url_pices[3] == "lights" or url_pices[3] == "sensors") and not bool(
-                    post_dictionary
-                ):
-                    # if was a request to scan for lights of sensors
-                    Thread(target=self._parent.scan_for_lights).start()
-                    time.sleep(
-                        7
-                    )  # give no more than 7 seconds for light scanning (otherwise will face app disconnection timeout)
-                    self.wfile.write(
-                        json.dumps(
-                            [
-                                {
-                                    "success": {
-                                        "/" + url_pices[3]: "Searching for new devices"
-                                    }
-                                }
-                            ]
-                        ).encode("utf8")
-                    )
-                else:  # create object
-                    # find the first unused id for new object
-                    i = 1
-                    while (str(i)) in self._parent.bridge_config[url_pices[3]]:
-                        i += 1
-                    if url_pices[3] == "scenes":
-                        post_dictionary.update(
-                            {
-                                "lightstates": {},
-                                "version": 2,
-                                "picture": "",
-                                "lastupdated": datetime.utcnow().strftime(
-                                    "%Y-%m-%dT%H:%M:%S"
-                                ),
-                            }
-                        )
-                    elif url_pices[3] == "groups":
-                        post_dictionary.update(
-                            {
-                                "action": {"on": False},
-                                "state": {"any_on": False, "all_on": False},
-                            }
-                        )
-                    elif url_pices[3] == "schedules":
-                        post_dictionary.update(
-                            {"created": datetime.now().strftime("%Y-%m-%dT%H:%M:%S")}
-                        )
-                        if post_dictionary["localtime"].startswith("PT"):
-                            timmer = post_dictionary["localtime"][2:]
-                            (h, m, s) = timmer.split(":")
-                            d = timedelta(hours=int(h), minutes=int(m), seconds=int(s))
-                            post_dictionary.update(
-                                {
-                                    "starttime": (datetime.utcnow() + d).strftime(
-                                        "%Y-%m-%dT%H:%M:%S"
-                                    )
-                                }
-                            )
-                        if not "status" in post_dictionary:
-                            post_dictionary.update({"status": "enabled"})
-                    elif url_pices[3] == "rules":
-                        post_dictionary.update({"owner": url_pices[2]})
-                        if not "status" in post_dictionary:
-                            post_dictionary.update({"status": "enabled"})
-                    elif url_pices[3] == "sensors":
-                        if post_dictionary["modelid"] == "PHWA01":
-                            post_dictionary.update({"state": {"status": 0}})
-                    self._parent.generate_sensors_state()
-                    self._parent.bridge_config[url_pices[3]][str(i)] = post_dictionary
-                    # print(
-                    #     json.dumps(
-                    #         [{"success": {"id": str(i)}}],
-                    #         sort_keys=True,
-                    #         indent=4,
-                    #         separators=(",", ": "),
-                    #     )
-                    # )
-                    self.wfile.write(
-                        json.dumps(
-                            [{"success": {"id": str(i)}}],
-                            sort_keys=True,
-                            indent=4,
-                            separators=(",", ": "),
-                        ).encode("utf8")
-                    )
-            else:
-                self.wfile.write(
-                    json.dumps(
-                        [
-                            {
-                                "error": {
-                                    "type": 1,
-                                    "address": self.path,
-                                    "description": "unauthorized user",
-                                }
-                            }
-                        ],
-                        sort_keys=True,
-                        indent=4,
-                        separators=(",", ": "),
-                    ).encode("utf8")
-                )
-                logger.warning("%s",
-                    json.dumps(
-                        [
-                            {
-                                "error": {
-                                    "type": 1,
-                                    "address": self.path,
-                                    "description": "unauthorized user",
-                                }
-                            }
-                        ],
-                        sort_keys=True,
-                        indent=4,
-                        separators=(",", ": "),
-                    )
-                )
-        elif "devicetype" in post_dictionary:  # this must be a new device registration
-            # create new user hash
-            s = hashlib.new(
-                "ripemd160", post_dictionary["devicetype"][0].encode("utf8")
-            ).digest()
-            username = s.hex()
-            self._parent.bridge_config["config"]["whitelist"][username] = {
-                "last use date": datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S"),
-                "create date": datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S"),
-                "name": post_dictionary["devicetype"],
-            }
-            self.wfile.write(
-                json.dumps(
-                    [{"success": {"username": username}}],
-                    sort_keys=True,
-                    indent=4,
-                    separators=(",", ": "),
-                ).encode("utf8")
-            )
-            print(
-                json.dumps(
-                    [{"success": {"username": username}}],
-                    sort_keys=True,
-                    indent=4,
-                    separators=(",", ": "),
-                )
-            )
+    def _encoding(self):
+        # The preferred of ENCODINGS in Accept-Encoding, gzip wins ties
+        best, best_q = None, 0
+        for item in self.headers.get("Accept-Encoding", "").split(","):
+            name, _, params = item.partition(";")
+            name = name.strip().lower()
+            if name not in ENCODINGS:
+                continue
+
+            q = 1
+            params = params.strip()
+            if params.startswith("q="):
+                try:
+                    q = float(params[2:])
+                except ValueError:
+                    continue
+            if q > best_q or (q == best_q and name == "gzip"):
+                best, best_q = name, q
+
+        return best
+
+    def _send_json(self, data, etag=None):
+        self._send(json.dumps(data).encode("utf8"), etag)
+
+    def _send_error(self, kind, description):
+        self._failed = True
+        self._send_json(error(kind, self._address, description))
+
+    def _cached(self, etag):
+        # Answers 304 when the client already has this version
+        if self._not_modified(etag):
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.end_headers()
+            return True
+
+        return False
+
+    def _not_modified(self, etag):
+        if_none_match = self.headers.get("If-None-Match")
+        if not if_none_match:
+            return False
+
+        tags = [tag.strip() for tag in if_none_match.split(",")]
+        return "*" in tags or etag in tags
+
+    def _stream_events(self, subscriber):
+        try:
+            while self._parent.run_service:
+                events = subscriber.wait(self._parent.events.keepalive)
+                self.wfile.write(self._parent.events.format(events))
+                self.wfile.flush()
+
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+
+        finally:
+            self._parent.events.unsubscribe(subscriber)
+
+    def _event_stream(self, **params):
+        if (
+            self.headers.get("hue-application-key")
+            not in self._parent.bridge_config["config"]["whitelist"]
+        ):
+            self.send_response(403)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        # Not sized, the stream ends when the connection does
+        self.send_header("Connection", "close")
         self.end_headers()
-        self._parent.save_config()
+        self.wfile.write(b": hi\n\n")
+        self.close_connection = True
+        self._stream_events(self._parent.events.subscribe())
+
+    def do_GET(self):
+        self._dispatch("GET")
+
+    def do_POST(self):
+        self._dispatch("POST")
 
     def do_PUT(self):
-        self._set_headers()
-        # print("in PUT method")
-        self.data_string = self.rfile.read(int(self.headers["Content-Length"]))
-        put_dictionary = json.loads(self.data_string)
-        url_pices = self.path.split("/")
-        if url_pices[2] in self._parent.bridge_config["config"]["whitelist"]:
-            if len(url_pices) == 4:
-                self._parent.bridge_config[url_pices[3]].update(put_dictionary)
-                response_location = "/" + url_pices[3] + "/"
-            if len(url_pices) == 5:
-                if url_pices[3] == "schedules":
-                    if (
-                        "status" in put_dictionary
-                        and put_dictionary["status"] == "enabled"
-                        and self._parent.bridge_config["schedules"][url_pices[4]][
-                            "localtime"
-                        ].startswith("PT")
-                    ):
-                        if "localtime" in put_dictionary:
-                            timmer = put_dictionary["localtime"][2:]
-                        else:
-                            timmer = self._parent.bridge_config["schedules"][
-                                url_pices[4]
-                            ]["localtime"][2:]
-                        (h, m, s) = timmer.split(":")
-                        d = timedelta(hours=int(h), minutes=int(m), seconds=int(s))
-                        put_dictionary.update(
-                            {
-                                "starttime": (datetime.utcnow() + d).strftime(
-                                    "%Y-%m-%dT%H:%M:%S"
-                                )
-                            }
-                        )
-                elif url_pices[3] == "scenes":
-                    if "storelightstate" in put_dictionary:
-                        for light in self._parent.bridge_config["scenes"][url_pices[4]][
-                            "lightstates"
-                        ]:
-                            self._parent.bridge_config["scenes"][url_pices[4]][
-                                "lightstates"
-                            ][light]["on"] = self._parent.bridge_config["lights"][
-                                light
-                            ][
-                                "state"
-                            ][
-                                "on"
-                            ]
-                            self._parent.bridge_config["scenes"][url_pices[4]][
-                                "lightstates"
-                            ][light]["bri"] = self._parent.bridge_config["lights"][
-                                light
-                            ][
-                                "state"
-                            ][
-                                "bri"
-                            ]
-                            if (
-                                "xy"
-                                in self._parent.bridge_config["scenes"][url_pices[4]][
-                                    "lightstates"
-                                ][light]
-                            ):
-                                del self._parent.bridge_config["scenes"][url_pices[4]][
-                                    "lightstates"
-                                ][light]["xy"]
-                            elif (
-                                "ct"
-                                in self._parent.bridge_config["scenes"][url_pices[4]][
-                                    "lightstates"
-                                ][light]
-                            ):
-                                del self._parent.bridge_config["scenes"][url_pices[4]][
-                                    "lightstates"
-                                ][light]["ct"]
-                            elif (
-                                "hue"
-                                in self._parent.bridge_config["scenes"][url_pices[4]][
-                                    "lightstates"
-                                ][light]
-                            ):
-                                del self._parent.bridge_config["scenes"][url_pices[4]][
-                                    "lightstates"
-                                ][light]["hue"]
-                                del self._parent.bridge_config["scenes"][url_pices[4]][
-                                    "lightstates"
-                                ][light]["sat"]
-                            if self._parent.bridge_config["lights"][light]["state"][
-                                "colormode"
-                            ] in ["ct", "xy",]:
-                                self._parent.bridge_config["scenes"][url_pices[4]][
-                                    "lightstates"
-                                ][light][
-                                    self._parent.bridge_config["lights"][light][
-                                        "state"
-                                    ]["colormode"]
-                                ] = self._parent.bridge_config[
-                                    "lights"
-                                ][
-                                    light
-                                ][
-                                    "state"
-                                ][
-                                    self._parent.bridge_config["lights"][light][
-                                        "state"
-                                    ]["colormode"]
-                                ]
-                            elif (
-                                self._parent.bridge_config["lights"][light]["state"][
-                                    "colormode"
-                                ]
-                                == "hs"
-                            ):
-                                self._parent.bridge_config["scenes"][url_pices[4]][
-                                    "lightstates"
-                                ][light]["hue"] = self._parent.bridge_config["lights"][
-                                    light
-                                ][
-                                    "state"
-                                ][
-                                    "hue"
-                                ]
-                                self._parent.bridge_config["scenes"][url_pices[4]][
-                                    "lightstates"
-                                ][light]["sat"] = self._parent.bridge_config["lights"][
-                                    light
-                                ][
-                                    "state"
-                                ][
-                                    "sat"
-                                ]
-
-                if url_pices[3] == "sensors":
-                    for key, value in put_dictionary.items():
-                        self._parent.bridge_config[url_pices[3]][url_pices[4]][
-                            key
-                        ].update(value)
-                else:
-                    self._parent.bridge_config[url_pices[3]][url_pices[4]].update(
-                        put_dictionary
-                    )
-                response_location = "/" + url_pices[3] + "/" + url_pices[4] + "/"
-            if len(url_pices) == 6:
-                if url_pices[3] == "groups":  # state is applied to a group
-                    if (
-                        "scene" in put_dictionary
-                    ):  # if group is 0 and there is a scene applied
-                        for light in self._parent.bridge_config["scenes"][
-                            put_dictionary["scene"]
-                        ]["lights"]:
-                            self._parent.bridge_config["lights"][light]["state"].update(
-                                self._parent.bridge_config["scenes"][
-                                    put_dictionary["scene"]
-                                ]["lightstates"][light]
-                            )
-                            if (
-                                "xy"
-                                in self._parent.bridge_config["scenes"][
-                                    put_dictionary["scene"]
-                                ]["lightstates"][light]
-                            ):
-                                self._parent.bridge_config["lights"][light]["state"][
-                                    "colormode"
-                                ] = "xy"
-                            elif (
-                                "ct"
-                                in self._parent.bridge_config["scenes"][
-                                    put_dictionary["scene"]
-                                ]["lightstates"][light]
-                            ):
-                                self._parent.bridge_config["lights"][light]["state"][
-                                    "colormode"
-                                ] = "ct"
-                            elif (
-                                "hue"
-                                or "sat"
-                                in self._parent.bridge_config["scenes"][
-                                    put_dictionary["scene"]
-                                ]["lightstates"][light]
-                            ):
-                                self._parent.bridge_config["lights"][light]["state"][
-                                    "colormode"
-                                ] = "hs"
-                            Thread(
-                                target=self._parent.send_light_request,
-                                args=[
-                                    light,
-                                    self._parent.bridge_config["scenes"][
-                                        put_dictionary["scene"]
-                                    ]["lightstates"][light],
-                                ],
-                            ).start()
-                            self._parent.update_group_stats(light)
-                    elif "bri_inc" in put_dictionary:
-                        self._parent.bridge_config["groups"][url_pices[4]]["action"][
-                            "bri"
-                        ] += int(put_dictionary["bri_inc"])
-                        if (
-                            self._parent.bridge_config["groups"][url_pices[4]][
-                                "action"
-                            ]["bri"]
-                            > 254
-                        ):
-                            self._parent.bridge_config["groups"][url_pices[4]][
-                                "action"
-                            ]["bri"] = 254
-                        elif (
-                            self._parent.bridge_config["groups"][url_pices[4]][
-                                "action"
-                            ]["bri"]
-                            < 1
-                        ):
-                            self._parent.bridge_config["groups"][url_pices[4]][
-                                "action"
-                            ]["bri"] = 1
-                        self._parent.bridge_config["groups"][url_pices[4]]["state"][
-                            "bri"
-                        ] = self._parent.bridge_config["groups"][url_pices[4]][
-                            "action"
-                        ][
-                            "bri"
-                        ]
-                        del put_dictionary["bri_inc"]
-                        put_dictionary.update(
-                            {
-                                "bri": self._parent.bridge_config["groups"][
-                                    url_pices[4]
-                                ]["action"]["bri"]
-                            }
-                        )
-                        for light in self._parent.bridge_config["groups"][url_pices[4]][
-                            "lights"
-                        ]:
-                            self._parent.bridge_config["lights"][light]["state"].update(
-                                put_dictionary
-                            )
-                            Thread(
-                                target=self._parent.send_light_request,
-                                args=[light, put_dictionary],
-                            ).start()
-                    elif url_pices[4] == "0":
-                        for light in self._parent.bridge_config["lights"].keys():
-                            self._parent.bridge_config["lights"][light]["state"].update(
-                                put_dictionary
-                            )
-                            Thread(
-                                target=self._parent.send_light_request,
-                                args=[light, put_dictionary],
-                            ).start()
-                        for group in self._parent.bridge_config["groups"].keys():
-                            self._parent.bridge_config["groups"][group][
-                                url_pices[5]
-                            ].update(put_dictionary)
-                            if "on" in put_dictionary:
-                                self._parent.bridge_config["groups"][group]["state"][
-                                    "any_on"
-                                ] = put_dictionary["on"]
-                                self._parent.bridge_config["groups"][group]["state"][
-                                    "all_on"
-                                ] = put_dictionary["on"]
-                    else:  # the state is applied to particular group (url_pices[4])
-                        if "on" in put_dictionary:
-                            self._parent.bridge_config["groups"][url_pices[4]]["state"][
-                                "any_on"
-                            ] = put_dictionary["on"]
-                            self._parent.bridge_config["groups"][url_pices[4]]["state"][
-                                "all_on"
-                            ] = put_dictionary["on"]
-                        for light in self._parent.bridge_config["groups"][url_pices[4]][
-                            "lights"
-                        ]:
-                            self._parent.bridge_config["lights"][light]["state"].update(
-                                put_dictionary
-                            )
-                            Thread(
-                                target=self._parent.send_light_request,
-                                args=[light, put_dictionary],
-                            ).start()
-                elif url_pices[3] == "lights":  # state is applied to a light
-                    Thread(
-                        target=self._parent.send_light_request,
-                        args=[url_pices[4], put_dictionary],
-                    ).start()
-                    for key in put_dictionary.keys():
-                        if key in ["ct", "xy"]:  # colormode must be set by bridge
-                            self._parent.bridge_config["lights"][url_pices[4]]["state"][
-                                "colormode"
-                            ] = key
-                        elif key in ["hue", "sat"]:
-                            self._parent.bridge_config["lights"][url_pices[4]]["state"][
-                                "colormode"
-                            ] = "hs"
-                    self._parent.update_group_stats(url_pices[4])
-                if (
-                    not url_pices[4] == "0"
-                ):  # group 0 is virtual, must not be saved in bridge configuration
-                    try:
-                        self._parent.bridge_config[url_pices[3]][url_pices[4]][
-                            url_pices[5]
-                        ].update(put_dictionary)
-                    except KeyError:
-                        self._parent.bridge_config[url_pices[3]][url_pices[4]][
-                            url_pices[5]
-                        ] = put_dictionary
-                if url_pices[3] == "sensors" and url_pices[5] == "state":
-                    for key in put_dictionary.keys():
-                        self._parent.sensors_state[url_pices[4]]["state"].update(
-                            {key: datetime.now().strftime("%Y-%m-%dT%H:%M:%S")}
-                        )
-                    if (
-                        "flag" in put_dictionary
-                    ):  # if a scheduler change te flag of a logical sensor then process the rules.
-                        self._parent.rules_processor()
-                response_location = (
-                    "/" + url_pices[3] + "/" + url_pices[4] + "/" + url_pices[5] + "/"
-                )
-            if len(url_pices) == 7:
-                try:
-                    self._parent.bridge_config[url_pices[3]][url_pices[4]][
-                        url_pices[5]
-                    ][url_pices[6]].update(put_dictionary)
-                except KeyError:
-                    self._parent.bridge_config[url_pices[3]][url_pices[4]][
-                        url_pices[5]
-                    ][url_pices[6]] = put_dictionary
-                self._parent.bridge_config[url_pices[3]][url_pices[4]][url_pices[5]][
-                    url_pices[6]
-                ] = put_dictionary
-                response_location = (
-                    "/"
-                    + url_pices[3]
-                    + "/"
-                    + url_pices[4]
-                    + "/"
-                    + url_pices[5]
-                    + "/"
-                    + url_pices[6]
-                    + "/"
+        self._dispatch("PUT")
+
+    def do_DELETE(self):
+        self._dispatch("DELETE")
+
+    def _dispatch(self, method):
+        url = urlsplit(self.path)
+        self.url_pices = (url.path.rstrip("/") or "/").split("/")
+        self._query = parse_qs(url.query)
+        # Hue errors address the resource, without the /api/<user> prefix
+        if len(self.url_pices) > 3:
+            self._address = "/" + "/".join(self.url_pices[3:])
+        else:
+            self._address = url.path
+        self._failed = False
+
+        # Always consumed, the next request on the connection follows it
+        try:
+            length = int(self.headers.get("Content-Length", 0))
+        except ValueError:
+            length = 0
+        self._body = self.rfile.read(length) if length > 0 else b""
+
+        route, params = self.routes.match(method, self.url_pices)
+        logger.debug("%s %s => %s", method, self.path, route and route.pattern)
+        if route is None:
+            if params:
+                self._send_error(
+                    METHOD_NOT_AVAILABLE,
+                    f"method, {method}, not available for resource, {self._address}",
                 )
-            response_dictionary = []
-            for key, value in put_dictionary.items():
-                response_dictionary.append(
-                    {"success": {response_location + key: value}}
+            else:
+                self._send_error(
+                    RESOURCE_NOT_AVAILABLE, f"resource, {self._address}, not available"
                 )
-            self.wfile.write(
-                json.dumps(
-                    response_dictionary,
-                    sort_keys=True,
-                    indent=4,
-                    separators=(",", ": "),
-                ).encode("utf8")
-            )
-            # print(
-            #     json.dumps(
-            #         response_dictionary,
-            #         sort_keys=True,
-            #         indent=4,
-            #         separators=(",", ": "),
-            #     )
-            # )
-        else:
-            self.wfile.write(
-                json.dumps(
-                    [
-                        {
-                            "error": {
-                                "type": 1,
-                                "address": self.path,
-                                "description": "unauthorized user",
-                            }
-                        }
-                    ],
-                    sort_keys=True,
-                    indent=4,
-                    separators=(",", ": "),
-                ).encode("utf8")
-            )
+            return
 
-    def do_DELETE(self):
-        self._set_headers()
-        url_pices = self.path.split("/")
-        if url_pices[2] in self._parent.bridge_config["config"]["whitelist"]:
-            del self._parent.bridge_config[url_pices[3]][url_pices[4]]
-            self.wfile.write(
-                json.dumps(
-                    [{"success": "/" + url_pices[3] + "/" + url_pices[4] + " deleted."}]
-                ).encode("utf8")
+        started = time.perf_counter()
+        try:
+            self._route(method, route, params)
+        finally:
+            route.record(started, self._failed)
+
+    def _route(self, method, route, params):
+        user = params.get("user")
+        if user is not None and not self._parent.api.authorized(user):
+            if method == "GET" and user in DISCOVERY_USERS:
+                self._send_json(self._discovery())
+            else:
+                logger.warning("Unauthorized user %s for %s", user, self.path)
+                self._send_error(UNAUTHORIZED_USER, "unauthorized user")
+            return
+
+        if method in ["POST", "PUT"]:
+            try:
+                params["body"] = json.loads(self._body)
+            except ValueError:
+                params["body"] = None
+
+            if not isinstance(params["body"], dict):
+                self._send_error(INVALID_JSON, "body contains invalid json")
+                return
+
+        getattr(self, route.handler)(**params)
+
+    def _exists(self, resource, key):
+        with self._parent.state.lock:
+            if key in self._parent.bridge_config.get(resource, {}):
+                return True
+
+        self._send_error(
+            RESOURCE_NOT_AVAILABLE, f"resource, /{resource}/{key}, not available"
+        )
+        return False
+
+    def _discovery(self):
+        # used by applications to discover the bridge
+        config = self._parent.state.value("config")
+        return {
+            "name": config["name"],
+            "datastoreversion": 59,
+            "swversion": config["swversion"],
+            "apiversion": config["apiversion"],
+            "mac": config["mac"],
+            "bridgeid": config["bridgeid"],
+            "factorynew": False,
+            "modelid": config["modelid"],
+        }
+
+    def _get_empty(self):
+        self._send(content_type="text/html")
+
+    def _get_description(self):
+        self._send(self._parent.description().encode("utf8"), content_type="text/xml")
+
+    def _get_all(self, user):
+        etag = self._parent.state.etag()
+        if not self._cached(etag):
+            self._send_state(None, etag)
+
+    def _get_metrics(self, user):
+        self._send_json(self._parent.metrics())
+
+    def _get_changes(self, user):
+        try:
+            since = int(self._query.get("since", ["0"])[0])
+        except ValueError:
+            self._send_error(INVALID_VALUE, "invalid value for parameter, since")
+            return
+
+        epoch = self._query.get("epoch", [None])[0]
+        self._send_json(self._parent.state.changes(since, CHANGE_RESOURCES, epoch))
+
+    def _get_resource(self, user, resource):
+        etag = self._parent.state.etag(resource)
+        if not self._cached(etag):
+            self._send_state(resource, etag)
+
+    def _get_new(self, user, resource):
+        # return new lights and sensors only
+        self._send_json({"lastscan": datetime.now().strftime("%Y-%m-%dT%H:%M:%S")})
+
+    def _get_group_zero(self, user):
+        self._send_json(self._parent.group_zero())
+
+    def _get_key(self, user, resource, key, section=None):
+        if resource != "config" and not self._exists(resource, key):
+            return
+
+        etag = self._parent.state.etag(resource, key)
+        if self._cached(etag):
+            return
+
+        path = [key] if section is None else [key, section]
+        try:
+            value = self._parent.state.value(resource, *path)
+        except (KeyError, TypeError):
+            self._send_error(
+                RESOURCE_NOT_AVAILABLE, f"resource, {self._address}, not available"
             )
+            return
+
+        self._send_json(value, etag)
+
+    def _register(self, body):
+        if "devicetype" not in body:
+            self._send_error(MISSING_PARAMETERS, "invalid/missing parameters in body")
+            return
+
+        # create new user hash
+        s = hashlib.new("ripemd160", body["devicetype"][0].encode("utf8")).digest()
+        username = s.hex()
+        user = {
+            "last use date": datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S"),
+            "create date": datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S"),
+            "name": body["devicetype"],
+        }
+        success = {"username": username}
+        if body.get("generateclientkey"):
+            # psk for entertainment streaming
+            success["clientkey"] = secrets.token_hex(16).upper()
+            user["clientkey"] = success["clientkey"]
+        with self._parent.state.lock:
+            self._parent.bridge_config["config"]["whitelist"][username] = user
+            self._parent.state.touch("config")
+
+        logger.info("Registered user %s", username)
+        self._send_json([{"success": success}])
+
+    def _create(self, user, resource, body):
+        try:
+            response = self._parent.api.create(self.url_pices, body)
+        except (KeyError, TypeError, AttributeError):
+            self._send_error(MISSING_PARAMETERS, "invalid/missing parameters in body")
+            return
+
+        if self._parent.api.scan(self.url_pices, body):
+            # give no more than 7 seconds for light scanning (otherwise will
+            # face app disconnection timeout)
+            self._delay_response(7)
+        self._send_json(response)
+
+    def _update(self, user, resource, body, key=None, section=None, field=None):
+        if key is not None and (resource, key) != ("groups", "0"):
+            if resource != "config" and not self._exists(resource, key):
+                return
+
+        try:
+            response = self._parent.api.update(self.url_pices, body)
+        except (KeyError, TypeError, AttributeError, ValueError):
+            logger.exception("Could not update %s", self._address)
+            self._send_error(INVALID_VALUE, "invalid value for parameter")
+            return
+
+        self._send_json(response)
+
+    def _delete(self, user, resource, key):
+        if self._exists(resource, key):
+            self._send_json(self._parent.api.delete(self.url_pices))
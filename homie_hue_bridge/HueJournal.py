@@ -0,0 +1,100 @@
+import os
+import json
+import logging
+from threading import Lock
+
+logger = logging.getLogger(__name__)
+
+
+def _apply(data, record):
+    resource = record["r"]
+    key = record.get("k")
+    if key is None:
+        data[resource] = record["v"]
+    elif "v" in record:
+        data.setdefault(resource, {})[key] = record["v"]
+    else:
+        data.get(resource, {}).pop(key, None)
+
+
+class HueJournal:
+    # Append only log of config changes, one json record per line holding the
+    # new value of a resource key (or of a whole resource when there is no
+    # key, and no value when the key was deleted). rotate() starts a new log
+    # before a snapshot of the config is saved, the rotated one is kept until
+    # that snapshot has replaced the previous one
+    def __init__(self, path):
+        self._path = path
+        self._rotated = f"{path}.1"
+        self._fp = open(path, "a")
+        self._lock = Lock()
+
+        self.size = self._fp.tell()
+        self.records = 0
+
+    @staticmethod
+    def replay(path, data):
+        # Applies the log(s) of path to data, returning the number of records
+        count = 0
+        for log in [f"{path}.1", path]:
+            if not os.path.exists(log):
+                continue
+
+            with open(log) as fp:
+                for line in fp:
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        # A torn write at the end of the log
+                        logger.warning("Ignoring incomplete journal record in %s", log)
+                        break
+
+                    _apply(data, record)
+                    count += 1
+
+        return count
+
+    def append(self, data, resource, key=None):
+        # Logs the current value of data[resource][key], read under the lock
+        # so records are in the order of the changes
+        with self._lock:
+            values = data.get(resource, {})
+            record = {"r": resource, "k": key}
+            if key is None:
+                record["v"] = values
+            elif key in values:
+                record["v"] = values[key]
+
+            line = json.dumps(record, separators=(",", ":")) + "\n"
+            self._fp.write(line)
+            self._fp.flush()
+            self.size += len(line)
+            self.records += 1
+
+    def sync(self):
+        with self._lock:
+            os.fsync(self._fp.fileno())
+
+    def rotate(self):
+        with self._lock:
+            os.fsync(self._fp.fileno())
+            self._fp.close()
+            if os.path.exists(self._rotated):
+                # The previous snapshot was never completed, keep both logs
+                with open(self._path) as src, open(self._rotated, "a") as dst:
+                    dst.write(src.read())
+                    dst.flush()
+                    os.fsync(dst.fileno())
+                os.remove(self._path)
+            else:
+                os.replace(self._path, self._rotated)
+            self._fp = open(self._path, "a")
+            self.size = 0
+
+    def discard_rotated(self):
+        if os.path.exists(self._rotated):
+            os.remove(self._rotated)
+
+    def close(self):
+        with self._lock:
+            self._fp.close()
@@ -0,0 +1,235 @@
+import os
+import json
+import time
+import hashlib
+import logging
+from threading import Lock
+
+from homie_hue_bridge.HueStateStore import CLOCK_FIELDS
+
+logger = logging.getLogger(__name__)
+
+# Fields that change with every light update, or every second for the clock.
+# Changes to only these are written at most every volatile_interval
+VOLATILE_FIELDS = {"lights": ["state"], "groups": ["state", "action"]}
+VOLATILE_WHITELIST_FIELDS = ["last use date"]
+
+
+def persistent(resource, value):
+    # value without its volatile fields
+    if resource in VOLATILE_FIELDS:
+        fields = VOLATILE_FIELDS[resource]
+        return {
+            key: {k: v for k, v in item.items() if k not in fields}
+            for key, item in value.items()
+        }
+
+    if resource == "config":
+        value = {k: v for k, v in value.items() if k not in CLOCK_FIELDS}
+        if "whitelist" in value:
+            value["whitelist"] = {
+                user: {
+                    k: v for k, v in entry.items() if k not in VOLATILE_WHITELIST_FIELDS
+                }
+                for user, entry in value["whitelist"].items()
+            }
+
+    return value
+
+
+class HuePersistence:
+    # Writes the bridge config after it changes. mark() is called for each
+    # modified resource, writes wait until no change has been marked for
+    # delay seconds (but no more than max_delay) and go to a temporary file
+    # which replaces the config once synced. Saves serialise a snapshot of the
+    # state store so writers are not blocked while the file is written.
+    # With a journal each change is appended to it instead, and the config is
+    # only saved (compacting the journal) once it grows past compact_size
+    delay = 2
+    max_delay = 30
+    volatile_interval = 300
+    sync_interval = 1
+    compact_size = 1 << 20
+
+    def __init__(self, timers, dispatcher, store, path, journal=None):
+        self._timers = timers
+        self._dispatcher = dispatcher
+        self._store = store
+        self._path = path
+        self._journal = journal
+        self._syncing = False
+        self._compacting = False
+
+        self._dirty = set()
+        self._due = None
+        self._since = None
+        self._handle = None
+        self._stale = False
+        self._failed = False
+        self._written = time.monotonic()
+        self._digests = {
+            resource: self._digest(resource) for resource in list(store.data.keys())
+        }
+        self._lock = Lock()
+        self._write_lock = Lock()
+
+        self.marked = 0
+        self.writes = 0
+        self.skipped = 0
+
+    def stats(self):
+        with self._lock:
+            stats = {
+                "dirty": sorted(self._dirty),
+                "stale": self._stale,
+                "marked": self.marked,
+                "writes": self.writes,
+                "skipped": self.skipped,
+            }
+            if self._journal:
+                stats["journal"] = {
+                    "size": self._journal.size,
+                    "records": self._journal.records,
+                }
+            return stats
+
+    def mark(self, resource, key=None):
+        if self._journal:
+            self._log(resource, key)
+            return
+
+        with self._lock:
+            now = time.monotonic()
+            self.marked += 1
+            self._dirty.add(resource)
+            self._due = now + self.delay
+            if self._since is None:
+                self._since = now
+            self._arm(self.delay)
+
+    def save(self):
+        with self._write_lock:
+            if self._journal:
+                # Changes from here on are in the new journal
+                self._journal.rotate()
+
+            body = json.dumps(
+                self._store.snapshot(),
+                sort_keys=True,
+                indent=4,
+                separators=(",", ": "),
+            )
+            directory = os.path.dirname(os.path.abspath(self._path))
+            temp = f"{self._path}.tmp"
+            with open(temp, "w") as fp:
+                fp.write(body)
+                fp.flush()
+                os.fsync(fp.fileno())
+            os.replace(temp, self._path)
+
+            # The rename itself must reach the disk too
+            fd = os.open(directory, os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+
+            if self._journal:
+                self._journal.discard_rotated()
+
+            self._written = time.monotonic()
+            self._stale = False
+            self._failed = False
+            self.writes += 1
+
+    def _log(self, resource, key):
+        self._journal.append(self._store.data, resource, key)
+
+        with self._lock:
+            self.marked += 1
+            if not self._syncing:
+                self._syncing = True
+                self._timers.call_later(
+                    self.sync_interval,
+                    self._dispatcher.submit,
+                    "journal",
+                    self._sync,
+                    {},
+                )
+
+            if self._journal.size > self.compact_size and not self._compacting:
+                self._compacting = True
+                self._dispatcher.submit("persistence", self._compact, {})
+
+    def _sync(self, key, data):
+        with self._lock:
+            self._syncing = False
+        self._journal.sync()
+
+    def _compact(self, key, data):
+        try:
+            self.save()
+        except Exception:
+            logger.exception("Could not compact journal")
+        finally:
+            with self._lock:
+                self._compacting = False
+
+    def _digest(self, resource):
+        value = persistent(resource, self._store.snapshot(resource))
+        return hashlib.md5(json.dumps(value, sort_keys=True).encode("utf8")).digest()
+
+    def _arm(self, delay):
+        when = time.monotonic() + delay
+        if self._handle and self._handle.when <= when:
+            return
+
+        if self._handle:
+            self._handle.cancel()
+        self._handle = self._timers.call_at(when, self._fire)
+
+    def _fire(self):
+        with self._lock:
+            self._handle = None
+            now = time.monotonic()
+            if self._dirty and now < self._due:
+                deadline = self._since + self.max_delay
+                if now < deadline:
+                    self._arm(min(self._due, deadline) - now)
+                    return
+
+        self._dispatcher.submit("persistence", self._flush, {})
+
+    def _flush(self, key, data):
+        with self._lock:
+            dirty, self._dirty = self._dirty, set()
+            self._since = None
+
+        try:
+            self._write(dirty)
+        except Exception:
+            logger.exception("Could not save config")
+            with self._lock:
+                self._dirty.update(dirty)
+                self._failed = True
+                self._arm(self.max_delay)
+
+    def _write(self, dirty):
+        changed = self._failed
+        for resource in dirty:
+            digest = self._digest(resource) if resource in self._store.data else None
+            if digest != self._digests.get(resource):
+                self._digests[resource] = digest
+                changed = True
+            else:
+                self._stale = True
+
+        wait = self.volatile_interval - (time.monotonic() - self._written)
+        if changed or (self._stale and wait <= 0):
+            self.save()
+            return
+
+        self.skipped += 1
+        if self._stale:
+            with self._lock:
+                self._arm(wait)
@@ -0,0 +1,114 @@
+import time
+from collections import defaultdict
+
+# Resources of the hue api, the values a {name:resource} parameter matches
+RESOURCES = [
+    "config",
+    "groups",
+    "lights",
+    "resourcelinks",
+    "rules",
+    "scenes",
+    "schedules",
+    "sensors",
+]
+
+# Hue api error types
+# https://developers.meethue.com/develop/hue-api/error-messages/
+UNAUTHORIZED_USER = 1
+INVALID_JSON = 2
+RESOURCE_NOT_AVAILABLE = 3
+METHOD_NOT_AVAILABLE = 4
+MISSING_PARAMETERS = 5
+INVALID_VALUE = 7
+
+TYPES = {"str": None, "resource": set(RESOURCES)}
+
+
+def error(kind, address, description):
+    return [{"error": {"type": kind, "address": address, "description": description}}]
+
+
+class Route:
+    __slots__ = ["method", "pattern", "handler", "segments", "calls", "errors", "time"]
+
+    def __init__(self, method, pattern, handler):
+        self.method = method
+        self.pattern = pattern
+        self.handler = handler
+        self.calls = 0
+        self.errors = 0
+        self.time = 0
+
+        # Literal segments are strings, parameters (name, allowed values)
+        self.segments = []
+        for segment in pattern.split("/"):
+            if segment.startswith("{") and segment.endswith("}"):
+                name, _, kind = segment[1:-1].partition(":")
+                self.segments.append((name, TYPES[kind or "str"]))
+            else:
+                self.segments.append(segment)
+
+    def match(self, parts):
+        params = {}
+        for segment, part in zip(self.segments, parts):
+            if isinstance(segment, str):
+                if segment != part:
+                    return None
+            else:
+                name, allowed = segment
+                if allowed is not None and part not in allowed:
+                    return None
+                params[name] = part
+
+        return params
+
+    def record(self, started, failed):
+        self.calls += 1
+        self.time += time.perf_counter() - started
+        if failed:
+            self.errors += 1
+
+
+class HueRouter:
+    # Routes method + path to a handler name. Routes are bucketed by method
+    # and number of path segments, each bucket only holds a few patterns
+    # which are tried in the order they were added
+    def __init__(self):
+        self._routes = defaultdict(list)
+        self._methods = defaultdict(set)
+
+    def add(self, method, pattern, handler):
+        route = Route(method, pattern, handler)
+        self._routes[(method, len(route.segments))].append(route)
+        self._methods[len(route.segments)].add(method)
+        return route
+
+    def match(self, method, parts):
+        # parts is the path split on "/". Returns (route, params), (None, True)
+        # when the path only exists for other methods or (None, False) when it
+        # does not exist
+        for route in self._routes.get((method, len(parts)), []):
+            params = route.match(parts)
+            if params is not None:
+                return route, params
+
+        for other in self._methods.get(len(parts), []):
+            if other != method:
+                for route in self._routes[(other, len(parts))]:
+                    if route.match(parts) is not None:
+                        return None, True
+
+        return None, False
+
+    def stats(self):
+        return {
+            f"{route.method} {route.pattern}": {
+                "calls": route.calls,
+                "errors": route.errors,
+                "time": round(route.time, 3),
+            }
+            for routes in self._routes.values()
+            for route in routes
+            if route.calls
+        }
@@ -0,0 +1,223 @@
+import logging
+from datetime import datetime, timedelta
+from collections import defaultdict
+from threading import Lock
+
+logger = logging.getLogger(__name__)
+
+# Rule conditions
+# https://developers.meethue.com/develop/hue-api/6-rules-api/#conditions
+TIME_FORMAT = "T%H:%M:%S"
+
+
+def _seconds(value):
+    # PThh:mm:ss
+    h, m, s = value[2:].split(":")
+    return int(h) * 3600 + int(m) * 60 + int(s)
+
+
+class Condition:
+    __slots__ = ["address", "path", "operator", "value", "delay", "window"]
+
+    def __init__(self, condition):
+        self.address = condition["address"]
+        self.path = self.address.strip("/").split("/")
+        self.operator = condition["operator"]
+        self.value = None
+        self.delay = None
+        self.window = None
+
+        value = condition.get("value")
+        if self.operator in ["eq", "gt", "lt"]:
+            self.value = {"true": True, "false": False}.get(value)
+            if self.value is None:
+                self.value = int(value)
+
+        elif self.operator == "ddx":
+            self.delay = _seconds(value)
+
+        elif self.operator in ["in", "not in"]:
+            start, end = value.split("/")
+            self.window = (
+                datetime.strptime(start, TIME_FORMAT).time(),
+                datetime.strptime(end, TIME_FORMAT).time(),
+            )
+
+    def resolve(self, config):
+        value = config
+        for part in self.path:
+            value = value[part]
+        return value
+
+    def in_window(self, now):
+        start, end = self.window
+        if start < end:
+            return start <= now <= end
+
+        return start <= now or now <= end
+
+    def evaluate(self, config, trigger, now, changed):
+        if self.operator == "dx":
+            return trigger == self.address
+
+        if self.operator == "ddx":
+            return trigger is self
+
+        if self.window:
+            return self.in_window(now.time()) == (self.operator == "in")
+
+        if self.operator not in ["eq", "gt", "lt"]:
+            return True
+
+        try:
+            # The changed values win, the stored state may not be updated yet
+            if self.address in changed:
+                actual = changed[self.address]
+            else:
+                actual = self.resolve(config)
+            if isinstance(self.value, bool):
+                return bool(actual) == self.value
+
+            actual = int(actual)
+        except (KeyError, TypeError, ValueError):
+            return False
+
+        if self.operator == "eq":
+            return actual == self.value
+        if self.operator == "gt":
+            return actual > self.value
+        return actual < self.value
+
+
+class HueRules:
+    # Rules compiled into conditions, indexed by the addresses they read so a
+    # change only evaluates the rules that depend on it. ddx delays and the
+    # start of in time windows are timers on the timer queue
+    def __init__(self, timers, config, execute):
+        self._timers = timers
+        self._config = config
+        self._execute = execute
+
+        self._rules = {}
+        self._index = defaultdict(set)
+        self._handles = defaultdict(dict)
+        self._lock = Lock()
+
+        self.evaluated = 0
+        self.triggered = 0
+
+    def stats(self):
+        return {
+            "rules": len(self._rules),
+            "addresses": len(self._index),
+            "evaluated": self.evaluated,
+            "triggered": self.triggered,
+        }
+
+    def load(self):
+        for rid in list(self._config["rules"].keys()):
+            self.update(rid)
+
+    def update(self, rid):
+        with self._lock:
+            self._remove(rid)
+            rule = self._config["rules"].get(rid)
+            if not rule or rule.get("status") != "enabled":
+                return
+
+            try:
+                conditions = [Condition(c) for c in rule["conditions"]]
+            except (KeyError, ValueError) as e:
+                logger.warning("Could not compile rule %s: %s", rid, e)
+                return
+
+            self._rules[rid] = conditions
+            for condition in conditions:
+                if condition.window:
+                    self._arm_window(rid, condition)
+                else:
+                    self._index[condition.address].add(rid)
+
+    def _remove(self, rid):
+        for condition in self._rules.pop(rid, []):
+            rules = self._index.get(condition.address)
+            if rules:
+                rules.discard(rid)
+                if not rules:
+                    del self._index[condition.address]
+
+        for handle in self._handles.pop(rid, {}).values():
+            handle.cancel()
+
+    def changed(self, resource, rid, section, changes):
+        triggered = []
+        with self._lock:
+            now = datetime.now()
+            changed = {
+                f"/{resource}/{rid}/{section}/{key}": value
+                for key, value in changes.items()
+            }
+            for address in changed.keys():
+                for rule in list(self._index.get(address, [])):
+                    for condition in self._rules[rule]:
+                        if condition.delay is not None and condition.address == address:
+                            self._arm_delay(rule, condition)
+
+                    if rule in triggered:
+                        continue
+
+                    if self._evaluate(rule, address, now, changed):
+                        triggered.append(rule)
+
+        for rule in triggered:
+            self._trigger(rule)
+
+    def _evaluate(self, rid, trigger, now, changed):
+        self.evaluated += 1
+        return all(
+            condition.evaluate(self._config, trigger, now, changed)
+            for condition in self._rules[rid]
+        )
+
+    def _trigger(self, rid):
+        logger.info("rule %s is triggered", rid)
+        self.triggered += 1
+        self._execute(rid)
+
+    def _fire(self, rid, condition):
+        with self._lock:
+            self._handles[rid].pop(id(condition), None)
+            if rid not in self._rules:
+                return
+
+            if condition.window:
+                self._arm_window(rid, condition)
+
+            execute = self._evaluate(rid, condition, datetime.now(), {})
+
+        if execute:
+            self._trigger(rid)
+
+    def _arm_delay(self, rid, condition):
+        # A new change restarts the delay
+        handle = self._handles[rid].pop(id(condition), None)
+        if handle:
+            handle.cancel()
+
+        self._handles[rid][id(condition)] = self._timers.call_later(
+            condition.delay, self._fire, rid, condition
+        )
+
+    def _arm_window(self, rid, condition):
+        # Evaluated as the window opens (or closes for not in)
+        now = datetime.now()
+        at = condition.window[0 if condition.operator == "in" else 1]
+        due = datetime.combine(now.date(), at)
+        if condition.operator == "not in":
+            due += timedelta(seconds=1)
+        if due <= now:
+            due += timedelta(days=1)
+
+        self._handles[rid][id(condition)] = self._timers.call_later(
+            (due - now).total_seconds(), self._fire, rid, condition
+        )
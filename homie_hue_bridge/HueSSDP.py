@@ -8,8 +8,14 @@ import logging
 
 logger = logging.getLogger(__name__)
 
+SSDP_ADDR = "239.255.255.250"
+SSDP_PORT = 1900
+
 
 class SSDP:
+    msearch_interval = 2
+    broadcast_interval = 60
+
     def __init__(self, ip, port, mac):
         self._ip = ip
         self._port = port
@@ -22,12 +28,8 @@ class SSDP:
         self._search_running = True
         self._broadcast_running = True
 
-        self.search_thread = Thread(
-            target=self.search, args=(self._ip, self._port, self._mac)
-        )
-        self.broadcast_thread = Thread(
-            target=self.broadcast, args=(self._ip, self._port, self._mac)
-        )
+        self.search_thread = Thread(target=self.search)
+        self.broadcast_thread = Thread(target=self.broadcast)
 
         self.search_thread.start()
         self.broadcast_thread.start()
@@ -36,129 +38,110 @@ class SSDP:
         self._search_running = False
         self._broadcast_running = False
 
-        logger.info("Waiting for ssdp threads")
-        self.search_thread.join()
-        self.broadcast_thread.join()
+        if hasattr(self, "search_thread"):
+            logger.info("Waiting for ssdp threads")
+            self.search_thread.join()
+            self.broadcast_thread.join()
+
+    def _uuid(self):
+        return "uuid:2f402f80-da50-11e1-9b23-" + self._mac
+
+    def _header(self, first_line, extra=""):
+        return (
+            first_line
+            + "\r\nHOST: 239.255.255.250:1900\r\n"
+            + extra
+            + "CACHE-CONTROL: max-age=100\r\nLOCATION: http://"
+            + self._ip
+            + ":"
+            + str(self._port)
+            + "/description.xml\r\nSERVER: Linux/3.14.0 UPnP/1.0 IpBridge/1.20.0\r\n"
+        )
+
+    def _targets(self):
+        return [
+            ("upnp:rootdevice", self._uuid() + "::upnp:rootdevice"),
+            (self._uuid(), self._uuid()),
+            ("urn:schemas-upnp-org:device:basic:1", self._uuid()),
+        ]
 
-    def search(self, ip, port, mac):
-        ssdp_addr = "239.255.255.250"
-        ssdp_port = 1900
-        multicast_group_c = ssdp_addr
-        server_address = ("", ssdp_port)
+    def _bridge_id(self):
+        return (self._mac[:6] + "FFFE" + self._mac[6:]).upper()
+
+    def search_responses(self):
         response_message = (
-            "HTTP/1.1 200 OK\r\nHOST: 239.255.255.250:1900\r\nEXT:\r\nCACHE-CONTROL: max-age=100\r\nLOCATION: http://"
-            + ip
-            + ":"
-            + str(port)
-            + "/description.xml\r\nSERVER: Linux/3.14.0 UPnP/1.0 IpBridge/1.20.0\r\nhue-bridgeid: "
-            + (mac[:6] + "FFFE" + mac[6:]).upper()
+            self._header("HTTP/1.1 200 OK", "EXT:\r\n")
+            + "hue-bridgeid: "
+            + self._bridge_id()
             + "\r\n"
         )
-        custom_response_message = {
-            0: {
-                "st": "upnp:rootdevice",
-                "usn": "uuid:2f402f80-da50-11e1-9b23-" + mac + "::upnp:rootdevice",
-            },
-            1: {
-                "st": "uuid:2f402f80-da50-11e1-9b23-" + mac,
-                "usn": "uuid:2f402f80-da50-11e1-9b23-" + mac,
-            },
-            2: {
-                "st": "urn:schemas-upnp-org:device:basic:1",
-                "usn": "uuid:2f402f80-da50-11e1-9b23-" + mac,
-            },
-        }
+        return [
+            bytes(response_message + "ST: " + st + "\r\nUSN: " + usn + "\r\n\r\n", "utf8")
+            for st, usn in self._targets()
+        ]
+
+    def notify_messages(self):
+        message = (
+            self._header("NOTIFY * HTTP/1.1")
+            + "NTS: ssdp:alive\r\nhue-bridgeid: "
+            + self._bridge_id()
+            + "\r\n"
+        )
+        messages = []
+        for nt, usn in self._targets():
+            packet = bytes(
+                message + "NT: " + nt + "\r\nUSN: " + usn + "\r\n\r\n", "utf8"
+            )
+            messages.extend([packet, packet])
+
+        return messages
+
+    @staticmethod
+    def is_discover(data):
+        data = data.decode("utf-8", "replace")
+        return (
+            data[0:19] == "M-SEARCH * HTTP/1.1" and data.find("ssdp:discover") != -1
+        )
+
+    @staticmethod
+    def response_delay():
+        return random.randrange(1, 10) / 10
+
+    def search_socket(self):
         sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        sock.bind(server_address)
+        sock.bind(("", SSDP_PORT))
 
-        group = socket.inet_aton(multicast_group_c)
+        group = socket.inet_aton(SSDP_ADDR)
         mreq = struct.pack("4sL", group, socket.INADDR_ANY)
         sock.setsockopt(socket.IPPROTO_IP, socket.IP_ADD_MEMBERSHIP, mreq)
+        return sock
 
+    def broadcast_socket(self):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.settimeout(self.msearch_interval + 0.5)
+        ttl = struct.pack("b", 1)
+        sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, ttl)
+        return sock
+
+    def search(self):
+        sock = self.search_socket()
         logger.info("Starting ssdp search...")
 
         while self._search_running:
             data, address = sock.recvfrom(1024)
-            data = data.decode("utf-8")
-            if data[0:19] == "M-SEARCH * HTTP/1.1":
-                if data.find("ssdp:discover") != -1:
-                    time.sleep(random.randrange(1, 10) / 10)
-                    logger.debug("Sending M-Search response to %s", address[0])
-                    for x in range(3):
-                        sock.sendto(
-                            bytes(
-                                response_message
-                                + "ST: "
-                                + custom_response_message[x]["st"]
-                                + "\r\nUSN: "
-                                + custom_response_message[x]["usn"]
-                                + "\r\n\r\n",
-                                "utf8",
-                            ),
-                            address,
-                        )
+            if self.is_discover(data):
+                time.sleep(self.response_delay())
+                logger.debug("Sending M-Search response to %s", address[0])
+                for response in self.search_responses():
+                    sock.sendto(response, address)
             time.sleep(0.5)
 
-    def broadcast(self, ip, port, mac):
-        ssdp_addr = "239.255.255.250"
-        ssdp_port = 1900
-        msearch_interval = 2
-        multicast_group_s = (ssdp_addr, ssdp_port)
-        message = (
-            "NOTIFY * HTTP/1.1\r\nHOST: 239.255.255.250:1900\r\nCACHE-CONTROL: max-age=100\r\nLOCATION: http://"
-            + ip
-            + ":"
-            + str(port)
-            + "/description.xml\r\nSERVER: Linux/3.14.0 UPnP/1.0 IpBridge/1.20.0\r\nNTS: ssdp:alive\r\nhue-bridgeid: "
-            + (mac[:6] + "FFFE" + mac[6:]).upper()
-            + "\r\n"
-        )
-        custom_message = {
-            0: {
-                "nt": "upnp:rootdevice",
-                "usn": "uuid:2f402f80-da50-11e1-9b23-" + mac + "::upnp:rootdevice",
-            },
-            1: {
-                "nt": "uuid:2f402f80-da50-11e1-9b23-" + mac,
-                "usn": "uuid:2f402f80-da50-11e1-9b23-" + mac,
-            },
-            2: {
-                "nt": "urn:schemas-upnp-org:device:basic:1",
-                "usn": "uuid:2f402f80-da50-11e1-9b23-" + mac,
-            },
-        }
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
-        sock.settimeout(msearch_interval + 0.5)
-        ttl = struct.pack("b", 1)
-        sock.setsockopt(socket.IPPROTO_IP, socket.IP_MULTICAST_TTL, ttl)
-
+    def broadcast(self):
+        sock = self.broadcast_socket()
         logger.info("Starting ssdp broadcast...")
 
         while self._broadcast_running:
-            for x in range(3):
-                sock.sendto(
-                    bytes(
-                        message
-                        + "NT: "
-                        + custom_message[x]["nt"]
-                        + "\r\nUSN: "
-                        + custom_message[x]["usn"]
-                        + "\r\n\r\n",
-                        "utf8",
-                    ),
-                    multicast_group_s,
-                )
-                sock.sendto(
-                    bytes(
-                        message
-                        + "NT: "
-                        + custom_message[x]["nt"]
-                        + "\r\nUSN: "
-                        + custom_message[x]["usn"]
-                        + "\r\n\r\n",
-                        "utf8",
-                    ),
-                    multicast_group_s,
-                )
-            time.sleep(60)
+            for message in self.notify_messages():
+                sock.sendto(message, (SSDP_ADDR, SSDP_PORT))
+            time.sleep(self.broadcast_interval)
@@ -0,0 +1,159 @@
+import re
+import random
+import logging
+from datetime import datetime, timedelta
+from threading import Lock
+
+logger = logging.getLogger(__name__)
+
+# Schedule times
+# https://developers.meethue.com/develop/hue-api/3-schedules-api/#time-patterns
+TIME = r"(\d{2}):(\d{2}):(\d{2})"
+RANDOM = rf"(?:A{TIME})?$"
+ABSOLUTE = re.compile(rf"^(\d{{4}})-(\d{{2}})-(\d{{2}})T{TIME}{RANDOM}")
+RECURRING = re.compile(rf"^W(\d{{1,3}})/T{TIME}{RANDOM}")
+TIMER = re.compile(rf"^(?:R(\d*)/)?PT{TIME}{RANDOM}")
+
+
+def _delta(h, m, s):
+    return timedelta(hours=int(h), minutes=int(m), seconds=int(s))
+
+
+def _jitter(groups):
+    if groups[0] is None:
+        return timedelta(0)
+
+    return timedelta(seconds=random.uniform(0, _delta(*groups).total_seconds()))
+
+
+def next_weekday(mask, h, m, s, after):
+    # mask has monday as bit 6 through sunday as bit 0
+    for days in range(8):
+        day = after.date() + timedelta(days=days)
+        due = datetime(day.year, day.month, day.day, int(h), int(m), int(s))
+        if due > after and int(mask) & (1 << 6 - due.weekday()):
+            return due
+
+
+class HueSchedules:
+    # Each enabled schedule is a timer for its next fire time. update() must
+    # be called when a schedule is created, edited or deleted to rearm it
+    catchup = 60
+
+    def __init__(self, timers, schedules, execute, expired):
+        self._timers = timers
+        self._schedules = schedules
+        self._execute = execute
+        self._expired = expired
+
+        self._handles = {}
+        self._repeats = {}
+        self._lock = Lock()
+
+    def load(self):
+        for sid in list(self._schedules.keys()):
+            self.update(sid)
+
+    def update(self, sid):
+        with self._lock:
+            if sid in self._handles:
+                self._handles.pop(sid)[0].cancel()
+            self._repeats.pop(sid, None)
+
+            schedule = self._schedules.get(sid)
+            if not schedule or schedule.get("status") != "enabled":
+                return
+
+            now = datetime.now()
+            due = self._first(
+                sid, schedule["localtime"], schedule.get("starttime"), now
+            )
+            if due is None:
+                logger.warning("Unsupported schedule time %s", schedule["localtime"])
+                return
+
+            if due < now - timedelta(seconds=self.catchup):
+                logger.info("Schedule %s was due at %s, skipping", sid, due)
+                if TIMER.match(schedule["localtime"]):
+                    self._timers.call_later(0, self._expired, sid)
+                return
+
+            self._arm(sid, due)
+
+    def _first(self, sid, localtime, starttime, now):
+        match = RECURRING.match(localtime)
+        if match:
+            due = next_weekday(*match.groups()[:4], now)
+            if due:
+                return due + _jitter(match.groups()[4:])
+            return None
+
+        match = TIMER.match(localtime)
+        if match:
+            repeats = match.group(1)
+            if localtime.startswith("R"):
+                self._repeats[sid] = int(repeats) if repeats else None
+
+            if starttime and not localtime.startswith("R"):
+                # starttime is when the timer expires, in UTC
+                utc = datetime.strptime(starttime, "%Y-%m-%dT%H:%M:%S")
+                due = now + (utc - datetime.utcnow())
+            else:
+                due = now + _delta(*match.groups()[1:4])
+
+            return due + _jitter(match.groups()[4:])
+
+        match = ABSOLUTE.match(localtime)
+        if match:
+            due = datetime(*[int(g) for g in match.groups()[:6]])
+            return due + _jitter(match.groups()[6:])
+
+    def _following(self, sid, localtime, due):
+        match = RECURRING.match(localtime)
+        if match:
+            due = next_weekday(*match.groups()[:4], due)
+            if due:
+                return due + _jitter(match.groups()[4:])
+            return None
+
+        match = TIMER.match(localtime)
+        if match and sid in self._repeats:
+            remaining = self._repeats[sid]
+            if remaining is None or remaining > 1:
+                if remaining:
+                    self._repeats[sid] = remaining - 1
+                return due + _delta(*match.groups()[1:4]) + _jitter(match.groups()[4:])
+
+    def _arm(self, sid, due):
+        delay = (due - datetime.now()).total_seconds()
+        handle = self._timers.call_later(max(delay, 0), self._fire, sid, due)
+        self._handles[sid] = (handle, due)
+
+    def _fire(self, sid, due):
+        with self._lock:
+            self._handles.pop(sid, None)
+            schedule = self._schedules.get(sid)
+            if not schedule or schedule.get("status") != "enabled":
+                return
+
+            if datetime.now() < due - timedelta(seconds=1):
+                # The wall clock moved back since the timer was armed
+                self._arm(sid, due)
+                return
+
+        logger.info("Execute schedule: %s", sid)
+        self._execute(sid)
+
+        with self._lock:
+            # A late fire still runs, occurrences missed meanwhile are skipped
+            now = datetime.now()
+            following = self._following(sid, schedule["localtime"], due)
+            while following and following < now - timedelta(seconds=self.catchup):
+                following = self._following(sid, schedule["localtime"], following)
+
+            if following:
+                self._arm(sid, following)
+                return
+
+        if TIMER.match(schedule["localtime"]):
+            self._expired(sid)
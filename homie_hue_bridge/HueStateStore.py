@@ -0,0 +1,210 @@
+import copy
+import gzip
+import time
+import json
+import zlib
+from datetime import datetime
+from threading import RLock
+
+# Clock fields are spliced into config when it is served rather than being
+# part of the cached serialisation
+CLOCK_FIELDS = ["UTC", "localtime"]
+
+# Content codings compressed() supports
+ENCODINGS = {
+    "gzip": lambda body: gzip.compress(body, 6),
+    "deflate": lambda body: zlib.compress(body, 6),
+}
+
+
+class HueStateStore:
+    # Writers hold lock across a mutation of data and its touch(). Readers use
+    # snapshot(), copies of each resource made under the lock once per version
+    # and shared until the resource is touched again, which must not be
+    # modified. A new snapshot only copies the keys touched since the previous
+    # one and shares the copies of the others with it
+    def __init__(self, data):
+        self.data = data
+        self.lock = RLock()
+        self.version = 0
+        # Distinguishes versions (and etags) from a previous run
+        self.epoch = "%x" % int(time.time())
+
+        self._versions = {}
+        self._key_versions = {}
+        self._cache = {}
+        self._snapshots = {}
+        self._compressed = {}
+        self._clock = (None, None)
+        self._listeners = []
+
+    def add_listener(self, fn):
+        # fn(resource, key) is called after each touch
+        self._listeners.append(fn)
+
+    def touch(self, resource, key=None):
+        # Must be called after mutating data[resource], invalidates the
+        # cached serialisation of that resource
+        with self.lock:
+            self.version += 1
+            self._versions[resource] = self.version
+
+            key_versions = self._key_versions.setdefault(resource, {})
+            if key is None:
+                for k in self.data.get(resource, {}):
+                    key_versions[k] = self.version
+            else:
+                key_versions[key] = self.version
+
+            for fn in self._listeners:
+                fn(resource, key)
+
+    def resource_version(self, resource):
+        return self._versions.get(resource, 0)
+
+    def key_version(self, resource, key):
+        return self._key_versions.get(resource, {}).get(key, 0)
+
+    def etag(self, resource=None, key=None):
+        # Responses including the clock also change with every second of it
+        clock = f"-{int(time.time())}" if resource in [None, "config"] else ""
+        if resource is None:
+            return f'W/"{self.epoch}-{self.version}{clock}"'
+
+        if key is None:
+            version = self.resource_version(resource)
+            return f'W/"{self.epoch}-{resource}-{version}{clock}"'
+
+        version = self.key_version(resource, key)
+        return f'W/"{self.epoch}-{resource}-{key}-{version}{clock}"'
+
+    def snapshot(self, resource=None):
+        # All resources when resource is None
+        with self.lock:
+            if resource is not None:
+                return self._snapshot(resource)
+
+            return {resource: self._snapshot(resource) for resource in self.data}
+
+    def _snapshot(self, resource):
+        version = self.resource_version(resource)
+        cached = self._snapshots.get(resource)
+        if cached and cached[0] == version:
+            return cached[1]
+
+        previous, since = (cached[1], cached[0]) if cached else ({}, -1)
+        key_versions = self._key_versions.get(resource, {})
+        value = {}
+        for key, item in self.data.get(resource, {}).items():
+            if key in previous and key_versions.get(key, 0) <= since:
+                value[key] = previous[key]
+            else:
+                value[key] = copy.deepcopy(item)
+
+        self._snapshots[resource] = (version, value)
+        return value
+
+    def value(self, resource, *keys):
+        # A snapshot of data[resource][key]..., config includes the clock
+        value = self.snapshot(resource)
+        if resource == "config":
+            value = dict(value, **self.clock())
+
+        for key in keys:
+            value = value[key]
+        return value
+
+    def changes(self, since, resources, epoch=None):
+        # Keys of resources modified after version `since`, deleted keys are
+        # returned as None. A `since` from another epoch (a previous run) or
+        # ahead of this one gets the whole resources, flagged as full
+        with self.lock:
+            full = since > self.version or epoch not in [None, self.epoch]
+            ret = {"epoch": self.epoch, "version": self.version, "full": full}
+            for resource in resources:
+                current = self.snapshot(resource)
+                if full:
+                    ret[resource] = current
+                    continue
+
+                ret[resource] = {
+                    key: current.get(key)
+                    for key, version in self._key_versions.get(resource, {}).items()
+                    if version > since
+                }
+
+            return ret
+
+    def clock(self):
+        now = int(time.time())
+        if self._clock[0] != now:
+            self._clock = (
+                now,
+                {
+                    "UTC": datetime.utcnow().strftime("%Y-%m-%dT%H:%M:%S"),
+                    "localtime": datetime.now().strftime("%Y-%m-%dT%H:%M:%S"),
+                },
+            )
+
+        return self._clock[1]
+
+    def _serialize(self, resource):
+        version = self.resource_version(resource)
+        cached = self._cache.get(resource)
+        if cached and cached[0] == version:
+            return cached[1]
+
+        value = self.snapshot(resource)
+        if resource == "config":
+            value = {k: v for k, v in value.items() if k not in CLOCK_FIELDS}
+
+        body = json.dumps(value).encode("utf8")
+        self._cache[resource] = (version, body)
+        return body
+
+    def serialized(self, resource):
+        body = self._serialize(resource)
+        if resource != "config":
+            return body
+
+        clock = json.dumps(self.clock()).encode("utf8")
+        if body == b"{}":
+            return clock
+
+        return clock[:-1] + b", " + body[1:]
+
+    def serialized_all(self):
+        return (
+            b"{"
+            + b", ".join(
+                json.dumps(resource).encode("utf8") + b": " + self.serialized(resource)
+                for resource in self.snapshot()
+            )
+            + b"}"
+        )
+
+    def compressed(self, resource, encoding, min_size=0):
+        # serialized(resource), or serialized_all() when resource is None,
+        # compressed once per version, None when it is smaller than min_size.
+        # Those including the clock change every second and are compressed at
+        # most that often
+        self.clock()
+        if resource is None:
+            version = (self.version, self._clock[0])
+        else:
+            version = self.resource_version(resource)
+            if resource == "config":
+                version = (version, self._clock[0])
+
+        cached = self._compressed.get((resource, encoding))
+        if cached and cached[0] == version:
+            return cached[1]
+
+        if resource is None:
+            body = self.serialized_all()
+        else:
+            body = self.serialized(resource)
+
+        compressed = ENCODINGS[encoding](body) if len(body) >= min_size else None
+        self._compressed[(resource, encoding)] = (version, compressed)
+        return compressed
@@ -0,0 +1,146 @@
+import time
+import heapq
+import logging
+import itertools
+from threading import Thread, Condition, Lock
+
+logger = logging.getLogger(__name__)
+
+
+class TimerHandle:
+    __slots__ = ["when", "fn", "args", "cancelled"]
+
+    def __init__(self, when, fn, args):
+        self.when = when
+        self.fn = fn
+        self.args = args
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class TimerQueue:
+    # A single thread (or the asyncio loop once attached) running callbacks
+    # at time.monotonic() deadlines
+    def __init__(self):
+        self._heap = []
+        self._cond = Condition()
+        self._sequence = itertools.count()
+        self._loop = None
+        self._thread = None
+        self._running = False
+
+    def start(self):
+        self._running = True
+        self._thread = Thread(target=self._run, daemon=True)
+        self._thread.start()
+
+    def attach_loop(self, loop):
+        # asyncio loop.time() is time.monotonic() so deadlines carry over
+        with self._cond:
+            self._loop = loop
+            pending = [handle for _, _, handle in self._heap]
+            self._heap = []
+
+        for handle in pending:
+            loop.call_soon_threadsafe(self._loop_schedule, handle)
+
+    def stop(self):
+        with self._cond:
+            self._running = False
+            self._cond.notify()
+
+        if self._thread:
+            self._thread.join()
+
+    def call_at(self, when, fn, *args):
+        handle = TimerHandle(when, fn, args)
+        if self._loop:
+            self._loop.call_soon_threadsafe(self._loop_schedule, handle)
+
+        else:
+            with self._cond:
+                heapq.heappush(self._heap, (when, next(self._sequence), handle))
+                self._cond.notify()
+
+        return handle
+
+    def call_later(self, delay, fn, *args):
+        return self.call_at(time.monotonic() + delay, fn, *args)
+
+    def _loop_schedule(self, handle):
+        self._loop.call_at(handle.when, self._fire, handle)
+
+    @staticmethod
+    def _fire(handle):
+        if handle.cancelled:
+            return
+
+        try:
+            handle.fn(*handle.args)
+        except Exception:
+            logger.exception("Timer callback %s failed", handle.fn)
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while self._running and (
+                    not self._heap or self._heap[0][0] > time.monotonic()
+                ):
+                    timeout = (
+                        self._heap[0][0] - time.monotonic() if self._heap else None
+                    )
+                    self._cond.wait(timeout)
+
+                if not self._running:
+                    return
+
+                due = []
+                now = time.monotonic()
+                while self._heap and self._heap[0][0] <= now:
+                    due.append(heapq.heappop(self._heap)[2])
+
+            for handle in due:
+                self._fire(handle)
+
+
+class Ticker:
+    # One repeating timer stepping every registered callback with the
+    # current time. It stops once no callback reports more work, until woken
+    def __init__(self, timers, rate=10):
+        self._timers = timers
+        self.rate = rate
+        self._callbacks = []
+        self._running = False
+        self._woken = False
+        self._lock = Lock()
+
+    def wake(self, fn):
+        with self._lock:
+            if fn not in self._callbacks:
+                self._callbacks.append(fn)
+
+            self._woken = True
+            if not self._running:
+                self._running = True
+                self._timers.call_later(1 / self.rate, self._tick)
+
+    def _tick(self):
+        with self._lock:
+            self._woken = False
+            callbacks = list(self._callbacks)
+
+        now = time.monotonic()
+        active = False
+        for fn in callbacks:
+            try:
+                active = fn(now) or active
+            except Exception:
+                logger.exception("Tick callback %s failed", fn)
+
+        with self._lock:
+            if active or self._woken:
+                self._timers.call_later(1 / self.rate, self._tick)
+            else:
+                self._running = False
@@ -0,0 +1,122 @@
+import time
+from threading import Lock
+
+INTERPOLATED = ["bri", "ct", "xy", "hue", "sat"]
+
+
+def interpolate(a, b, f):
+    if isinstance(a, list):
+        return [round(x + (y - x) * f, 4) for x, y in zip(a, b)]
+
+    return int(round(a + (b - a) * f))
+
+
+class HueTransitions:
+    # Fades lights to a new state over its transitiontime. All running
+    # fades are stepped together from the shared ticker, and a new state for
+    # a light retargets its fade from wherever it currently is
+    def __init__(self, ticker, emit):
+        self._ticker = ticker
+        self._emit = emit
+
+        self._sent = {}
+        self._active = {}
+        self._lock = Lock()
+
+        self.started = 0
+        self.retargeted = 0
+        self.frames = 0
+
+    def stats(self):
+        return {
+            "active": len(self._active),
+            "started": self.started,
+            "retargeted": self.retargeted,
+            "frames": self.frames,
+        }
+
+    def sent(self, light, data):
+        # Keeps track of what the device was last told
+        with self._lock:
+            self._sent.setdefault(light, {}).update(data)
+
+    def cancel(self, light):
+        with self._lock:
+            self._active.pop(light, None)
+
+    def start(self, light, target, duration):
+        target = {k: v for k, v in target.items() if k != "transitiontime"}
+        with self._lock:
+            now = time.monotonic()
+            current = dict(self._sent.get(light, {}))
+            # The brightness the bridge holds for the light, which a fade out
+            # leaves the device at once it is off
+            restore = current.get("bri")
+            if light in self._active:
+                self.retargeted += 1
+                _, _, _, end, previous, _ = self._active[light]
+                restore = previous.get("bri", end.get("bri", restore))
+                current.update(self._frame(light, now)[0])
+            else:
+                self.started += 1
+
+            fading_in = target.get("on") is True and not current.get("on")
+            fading_out = target.get("on") is False and current.get("on")
+
+            start = {}
+            end = {}
+            for key in INTERPOLATED:
+                if key in target and key in current:
+                    start[key] = current[key]
+                    end[key] = target[key]
+
+            if fading_in and "bri" in current:
+                start["bri"] = 1
+                end["bri"] = target.setdefault("bri", restore)
+
+            elif fading_out and "bri" in current:
+                start["bri"] = current["bri"]
+                end["bri"] = 1
+                target.setdefault("bri", restore)
+
+            if not start or duration <= 0:
+                self._active.pop(light, None)
+                self._emit({light: target})
+                return
+
+            self._active[light] = (
+                now,
+                duration,
+                start,
+                end,
+                target,
+                fading_in or fading_out,
+            )
+            self._ticker.wake(self._tick)
+
+    def _frame(self, light, now):
+        # Returns the state of light at now, and whether its fade is done
+        started, duration, start, end, target, lit = self._active[light]
+        f = (now - started) / duration
+        if f >= 1:
+            return target, True
+
+        frame = {key: interpolate(start[key], end[key], f) for key in start}
+        if lit:
+            frame["on"] = True
+
+        return frame, False
+
+    def _tick(self, now):
+        frames = {}
+        with self._lock:
+            for light in list(self._active.keys()):
+                frames[light], done = self._frame(light, now)
+                if done:
+                    del self._active[light]
+
+            self.frames += len(frames)
+            if frames:
+                self._emit(frames)
+
+            return bool(self._active)